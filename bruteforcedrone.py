@@ -1,5 +1,27 @@
-from itertools import permutations, chain, combinations
+from collections import OrderedDict, namedtuple
+from itertools import permutations, chain, combinations, product
+import asyncio
+import bisect
+import hashlib
+import json
 import math
+import mmap
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pulp
+except ImportError:
+    pulp = None
 
 class Drone:
     """
@@ -86,6 +108,11 @@ class Drone:
             self.current_packages.remove(package)
         print("Package delivered")
         
+    def snapshot(self, time=0):
+        """Returns the drone's battery, position and load as an immutable DroneState"""
+        return DroneState(self.battery, self.coordinate.x, self.coordinate.y, self.coordinate.z, self.current_load(), time,
+                          self.coordinate)
+
     def set_altitude(self,altitude):
         self.altitude = altitude
         
@@ -119,6 +146,27 @@ class Drone:
         
 
 
+class DroneState(namedtuple('DroneState', ['battery', 'x', 'y', 'z', 'load', 'time', 'coordinate'], defaults=(None,))):
+    """
+    DroneState class representing an immutable snapshot of a drone for what-if simulation
+    Transitions (Delivery.state_fly, state_charge, state_load, state_drop) return new states, so branches share nothing mutable
+    Attributes:
+    - battery (float): battery left
+    - x, y, z (float): position
+    - load (float): weight on board
+    - time (float): time elapsed
+    - coordinate (Coordinate): the location object the drone is at, so a leg to a package sharing it costs nothing
+      as in simulate_path; None if the state only knows x, y, z
+    """
+    __slots__ = ()
+
+    def location(self):
+        """Returns the location object the drone is at, or a new Coordinate at its position"""
+        if self.coordinate is not None:
+            return self.coordinate
+        return Coordinate(self.x, self.y, self.z)
+
+
 class Coordinate:
     """
     Coordinate class representing the x, y position of drone location and delivery location
@@ -203,21 +251,96 @@ class Delivery:
     - drone (Drone): drone that will be delivering packages
     - packages (List[Package]): list of packages to be delivered in current delivery
     - remaining_packages (List[Package]): current list of packages to be delivered in current delivery
+    - rejected_packages (List[List]): [package, reason code] of every package filter_packages turned down
     - base (Coordinate): initial coordinates of the drone
+    - optimize_charging (bool): co-optimize trip order and charge amounts instead of topping up greedily
+    - charge_plan (List[float]): charging time before every pool of best_path, None for greedy top-up
+    - planner (str): search used to find best_path, 'bruteforce', 'partition', 'anytime', 'milp' or 'audit'
+    - time_budget (float): wall-clock seconds the 'anytime' and 'milp' planners may search, None for no limit
+    - autoplan (bool): plan in the constructor; if False best_path stays empty until plan_async() is awaited
+    - leg_cache (LegCostCache): persistent cache of leg costs shared across runs, None to always compute them
+    - workers (int): worker processes checking candidate paths over a SharedProblem, 1 to check them in process
+    - wind_ensemble (WindEnsemble): wind error samples used to score the robustness of a path
+    - breach_tolerance (float): chance constraint, highest probability that a planned path breaches the emergency reserve
+      under wind_ensemble, None to plan on the nominal wind only
+    - fleet_tables (FleetCostTables): leg costs precomputed for a fleet of drone models, None to compute them for this drone
+    - kernel (str): backend checking candidate paths over integer-encoded arrays, 'numba' or 'python',
+      None to check them on the Package objects
+    - cluster (bool): split the packages into groups no trip can mix and plan every group on its own
+    - plan_cache (PlanCache): plans of batches seen before, keyed by problem_fingerprint(), None to always search
+    - plan_report (PlanUpdate): battery, lower bound and gap of the last plan() result
+    - checkpoint (str): file the 'partition', 'anytime' and 'audit' searches save their progress to and resume from,
+      None to keep it in memory; with cluster set every group uses the file name plus its fingerprint
+    - terrain (TerrainGrid): ground and rooftop elevation every leg cruises above, None for flat ground
     """
 
-    def __init__(self, drone, packages, env, setenv=False):
+    FILTER_BATTERY = 1
+    FILTER_WEIGHT = 2
+    FILTER_DEADLINE = 3
+
+    def __init__(self, drone, packages, env, setenv=False, optimize_charging=False, planner='bruteforce', autoplan=True, leg_cache=None,
+                 workers=1, wind_ensemble=None, breach_tolerance=None, fleet_tables=None,
+                 kernel=None, cluster=False, plan_cache=None, checkpoint=None, terrain=None):
         self.drone = drone
         self.base = Coordinate(0, 0,0)
         self.HEIGHT_CONSTANT = 1000
         self.BCR_CONSTANT = 1000
         self.priority_dict = {'N':10e7, 'F': 20, 'U': 10}
+        self.lateness_weights = {'N': 1, 'F': 5, 'U': 10}
         self.packages = packages
         self.remaining_packages = packages
+        self.rejected_packages = []
         self.env = env
         self.setenv = setenv
+        self.terrain = terrain
+        self.leg_table = None
+        self.leg_cache = leg_cache
+        self.fleet_tables = fleet_tables
+        self.kernel = kernel
+        self.cluster = cluster
+        self.plan_cache = plan_cache
+        self.plan_report = None
+        self.checkpoint = checkpoint
+        self.CHECKPOINT_INTERVAL = 30
+        self.AUDIT_CHUNK = 10000
+        self.workers = workers
+        self.SHARD_SIZE = 2000
+        self.arrival_bounds = dict()
+        self.trip_indexes = dict()
+        self.optimize_charging = optimize_charging
+        self.charge_plan = None
+        self.CHARGE_LEVELS = 20
+        self.planner = planner
+        self.time_budget = None
+        self.breach_tolerance = breach_tolerance
+        if wind_ensemble is None and breach_tolerance is not None:
+            wind_ensemble = WindEnsemble()
+        self.wind_ensemble = wind_ensemble
+        self.pool_geometries = dict()
         self.filter_packages()
-        self.best_path = self.get_best_path(self.remaining_packages.copy())
+        self.best_path = []
+        if autoplan:
+            self.best_path = self.plan(self.remaining_packages.copy())
+            self.apply_charge_schedule()
+
+    def __getstate__(self):
+        """Drops the caches keyed by id(), they are only valid in the process that built them"""
+        state = self.__dict__.copy()
+        state['leg_table'] = None
+        state['arrival_bounds'] = dict()
+        state['trip_indexes'] = dict()
+        state['leg_cache'] = None
+        state['pool_geometries'] = dict()
+        state['fleet_tables'] = None
+        state['plan_cache'] = None
+        return state
+
+    def apply_charge_schedule(self):
+        """Reorders best_path and sets charge_plan from the optimal charge schedule, if enabled"""
+        if self.optimize_charging and len(self.best_path)>0:
+            schedule = self.optimal_charge_schedule(self.best_path)
+            if schedule is not None:
+                self.best_path, self.charge_plan, _ = schedule
         
        
                 
@@ -248,6 +371,120 @@ class Delivery:
         
         return self.path_maker(all_path_list,char)
         
+    def audit_size(self, packages):
+        """Returns the number of candidates the audit brute force enumerates: every permutation of the packages
+        times every way to cut it into pools"""
+        if len(packages)==0:
+            return 0
+        return math.factorial(len(packages)) * (1<<(len(packages)-1))
+
+    def audit_path(self, packages, index):
+        """Returns candidate index of the audit brute force without enumerating the ones before it
+        The index is a permutation rank times 2^(n-1) plus a cut mask; the rank is unranked in the factorial number
+        system and bit i of the mask cuts the permutation into a new pool after position i"""
+        rank, mask = divmod(index, 1<<(len(packages)-1))
+        return self.cut_permutation(self.unrank_permutation(packages, rank), mask)
+
+    def unrank_permutation(self, packages, rank):
+        """Returns the permutation of packages with a given rank in lexicographic order of positions"""
+        remaining = list(packages)
+        order = []
+        for k in range(len(packages), 0, -1):
+            i, rank = divmod(rank, math.factorial(k-1))
+            order.append(remaining.pop(i))
+        return order
+
+    def cut_permutation(self, order, mask):
+        """Cuts a permutation into pools, bit i of mask starting a new pool after position i"""
+        path = [[order[0]]]
+        for i in range(1, len(order)):
+            if mask & (1<<(i-1)):
+                path.append([])
+            path[-1].append(order[i])
+        return path
+
+    def audit_best_path(self, packages, chunk_size=None, checkpoint=None, max_chunks=None):
+        """Exhaustive brute force in fixed memory for audits: candidates are unranked by index one chunk of
+        chunk_size at a time and checked like filtered_paths, keeping only the cheapest
+        With a checkpoint file, progress is saved after every chunk and resumed from on the next call; the file
+        must belong to the same problem_fingerprint(). max_chunks stops early, e.g. to share a worker
+        Returns [best path, whether every candidate was checked]"""
+        if len(packages)==0:
+            return [[], True]
+        if chunk_size is None:
+            chunk_size = self.AUDIT_CHUNK
+        packages = Delivery.canonical_order(packages)
+        total = self.audit_size(packages)
+        state = {'fingerprint': self.problem_fingerprint(packages), 'next': 0, 'best': None, 'battery': 10e7}
+        state = self.read_checkpoint(checkpoint, state['fingerprint']) or state
+        chunks = 0
+        masks = 1<<(len(packages)-1)
+        #POOL BATTERIES, CLEARED WHEN FULL SO MEMORY STAYS BOUNDED
+        pool_batteries = dict()
+        limit = self.drone.max_battery - self.drone.emergency_amount_battery
+        rank = None
+        while state['next']<total and (max_chunks is None or chunks<max_chunks):
+            end = min(state['next'] + chunk_size, total)
+            for index in range(state['next'], end):
+                if index//masks!=rank:
+                    rank = index//masks
+                    order = self.unrank_permutation(packages, rank)
+                path = self.cut_permutation(order, index % masks)
+                if self.is_time_dependent():
+                    if not self.path_verifier(path):
+                        continue
+                    battery = self.path_battery_required(path)
+                    if battery<state['battery']:
+                        state['best'], state['battery'] = index, battery
+                    continue
+                #FIXED ENVIRONMENT: POOL COSTS ARE ADDITIVE, SO ONLY A CANDIDATE BEATING THE BEST NEEDS ITS DEADLINES CHECKED
+                battery = 0
+                for pool in path:
+                    if Delivery.weight_sum(pool)>self.drone.capacity:
+                        break
+                    key = tuple(id(package) for package in pool)
+                    if key not in pool_batteries:
+                        if len(pool_batteries)>=self.AUDIT_CHUNK:
+                            pool_batteries.clear()
+                        pool_batteries[key] = self.battery_required(pool)
+                    if pool_batteries[key]>limit:
+                        break
+                    battery += pool_batteries[key]
+                else:
+                    if battery<state['battery'] and self.path_verifier(path):
+                        state['best'], state['battery'] = index, battery
+            state['next'] = end
+            chunks += 1
+            if checkpoint is not None:
+                self.write_checkpoint(checkpoint, state)
+        best_path = [] if state['best'] is None else self.audit_path(packages, state['best'])
+        return [best_path, state['next']>=total]
+
+    def canonical_paths(self, packages):
+        """Returns every path as a canonical multiset of pools, listed by their first package in input order
+        Battery does not depend on the order of pools (each starts and ends at base), so paths that only
+        differ in pool order are generated once and ordered later by feasible_pool_order"""
+        paths = []
+        capacity = self.drone.capacity
+
+        def assign(i, pools):
+            if i==len(packages):
+                for orders in product(*[permutations(pool) for pool in pools]):
+                    paths.append([list(order) for order in orders])
+                return
+            for pool in pools:
+                if Delivery.weight_sum(pool) + packages[i].weight>capacity:
+                    continue
+                pool.append(packages[i])
+                assign(i+1, pools)
+                pool.pop()
+            pools.append([packages[i]])
+            assign(i+1, pools)
+            pools.pop()
+
+        assign(0, [])
+        return paths
+
     def remove_duplicates(self,all_paths):
         new_paths = []
         for path in all_paths:
@@ -317,6 +554,12 @@ class Delivery:
         return paths
 
     def simulate_time_and_battery(self, path):
+        return self.simulate_path(path)[0]
+
+    def simulate_path(self, path, charge_plan=None):
+        """Simulates a path and returns the delivery time of every package, the battery used by every pool
+        and the time at which the drone is back at base
+        If a charge plan is given, the drone charges for the planned time before every pool instead of topping up greedily"""
         #print("SIMULATING")
         #print(path)
         time_elapsed = 0
@@ -324,17 +567,18 @@ class Delivery:
         i=0
         mx_battery = self.drone.max_battery
         curr_battery = mx_battery
-        package_time_list = []    
-    
+        package_time_list = []
+        pool_battery_list = []
+
         while i<len(path):
             pool_to_deliver = path[i]
-            battery_required = self.battery_required(pool_to_deliver)
-            if battery_required+self.drone.emergency_amount_battery>curr_battery:
-                
-                #print("CHARGING")
-                time_elapsed+=self.charge_time(pool_to_deliver,curr_battery)
-                curr_battery = battery_required+self.drone.emergency_amount_battery
-                #print(f"AFTER SIMULATION CHARGE: {curr_battery}")
+            if charge_plan is not None and charge_plan[i]>0:
+                time_elapsed += charge_plan[i]
+                curr_battery = min(curr_battery + charge_plan[i]*self.drone.charge_rate, mx_battery)
+            #print("CHARGING")
+            charge, curr_battery = self.top_up(pool_to_deliver, curr_battery, time_elapsed)
+            time_elapsed += charge
+            battery_required = self.battery_required(pool_to_deliver,start_time=time_elapsed)
 
             j=0
             while j<len(path[i]):
@@ -353,11 +597,12 @@ class Delivery:
             
             curr_location = self.base
             curr_battery -= battery_required
+            pool_battery_list.append(battery_required)
             i+=1
-        
+
         #print(package_time_list)
         #print(f'Final: {curr_battery}')
-        return package_time_list
+        return package_time_list, pool_battery_list, time_elapsed
                 
                 
                 
@@ -366,9 +611,158 @@ class Delivery:
         package_time_list = self.simulate_time_and_battery(path)
         for package_time in package_time_list:
             if self.priority_dict[package_time[0].priority]<package_time[1]:
+                #GREEDY TOP-UP MISSES A DEADLINE, A BETTER CHARGE SCHEDULE MAY STILL MEET IT
+                if self.optimize_charging:
+                    return self.optimal_charge_schedule(path) is not None
+                return False
+        return True
+
+    def pool_timings(self, pool):
+        """Returns the arrival time of every package of a pool relative to its departure, and the time to get back to base"""
+        offsets = []
+        time_elapsed = 0
+        curr = self.base
+        for package in pool:
+            time_elapsed += self.time_drain(curr, package.location)
+            offsets.append(time_elapsed)
+            curr = package.location
+        time_elapsed += self.time_drain(curr, self.base)
+        return offsets, time_elapsed
+
+    def earliest_arrival(self, package):
+        """Returns the earliest time a package can possibly be delivered: a direct flight from base with no charging"""
+        if id(package) not in self.arrival_bounds:
+            self.arrival_bounds[id(package)] = self.time_drain(self.base, package.location)
+        return self.arrival_bounds[id(package)]
+
+    def urgent_batch_feasible(self, packages):
+        """Checks a necessary condition for all deadlines of a batch to be met, without enumerating paths
+        Deliveries happen one after another and every location is reached by a leg into it, so the packages
+        due by a deadline need at least the sum of the cheapest inbound legs of their distinct locations
+        (packages sharing a location object are dropped off after one leg)"""
+        locations = [self.base] + [package.location for package in packages]
+        min_inbound = dict()
+        for package in packages:
+            if id(package.location) not in min_inbound:
+                min_inbound[id(package.location)] = min(self.time_drain(location, package.location) for location in locations
+                                                        if location is not package.location)
+        due = sorted(packages, key=lambda package: self.priority_dict[package.priority])
+        time_needed = 0
+        for package in due:
+            #THE LEG INTO A LOCATION IS COUNTED ONCE, FOR ITS MOST URGENT PACKAGE
+            time_needed += min_inbound.pop(id(package.location), 0)
+            deadline = self.priority_dict[package.priority]
+            if time_needed>deadline or self.earliest_arrival(package)>deadline:
+                return False
+        return True
+
+    def pool_due_time(self, pool, offsets):
+        """Returns the latest departure time at which a pool still meets all of its deadlines"""
+        due = 10e7
+        for package, offset in zip(pool, offsets):
+            due = min(due, self.priority_dict[package.priority] - offset)
+        return due
+
+    def edd_order(self, path):
+        """Returns the pools of a path sorted by earliest due date (deadline-first seeding): a pool is due back at base
+        by its latest departure plus its duration"""
+        def due_back(pool):
+            offsets, duration = self.pool_timings(pool)
+            return self.pool_due_time(pool, offsets) + duration
+        return sorted(path, key=due_back)
+
+    def path_deadline_bound_verifier(self, path):
+        """Rejects paths that miss a deadline even without charging, before simulating battery"""
+        if self.optimize_charging:
+            #POOLS MAY BE REORDERED BY THE CHARGE SCHEDULE, path_priority_verifier SEARCHES THE ORDERS
+            return True
+        time_elapsed = 0
+        for pool in path:
+            offsets, duration = self.pool_timings(pool)
+            if time_elapsed>self.pool_due_time(pool, offsets):
                 return False
+            time_elapsed += duration
         return True
 
+    def optimal_charge_schedule(self, path, levels=None):
+        """Returns the order of pools and the charging time before each of them that minimizes the completion time
+        while meeting every priority deadline, as [ordered_path, charge_plan, completion_time], or None if no schedule fits
+        DP over (set of pools delivered, battery level bucket), keeping the earliest state per bucket
+        Under a WindForecast the order of the pools sets their battery, so they keep the order of path and only the
+        charging is scheduled"""
+        if levels is None:
+            levels = self.CHARGE_LEVELS
+        mx_battery = self.drone.max_battery
+        EMERGENCY_AMOUNT = self.drone.emergency_amount_battery
+        charge_rate = self.drone.charge_rate
+        step = mx_battery/levels
+        timings = [self.pool_timings(pool) for pool in path]
+        deadlines = [[self.priority_dict[package.priority] for package in pool] for pool in path]
+        full = (1<<len(path)) - 1
+
+        def bucket(battery):
+            return min(int(battery/step), levels)
+
+        def departure_options(k, curr_time, curr_battery):
+            #EXACT TOP-UP (OR NO CHARGE) PLUS CHARGING TO EVERY LEVEL ABOVE IT
+            required = self.battery_required(path[k],start_time=curr_time)
+            targets = [max(curr_battery, required+EMERGENCY_AMOUNT)]
+            level = targets[0]
+            while level<mx_battery:
+                level = min((bucket(level)+1)*step, mx_battery)
+                targets.append(level)
+            for target in targets:
+                if target>mx_battery:
+                    continue
+                charge = (target-curr_battery)/charge_rate
+                start = curr_time + charge
+                if self.is_time_dependent():
+                    required = self.battery_required(path[k],start_time=start)
+                if required+EMERGENCY_AMOUNT>target:
+                    continue
+                yield charge, start, target-required
+
+        #layers[mask][bucket] = [time, battery, previous bucket, pool, charge]
+        layers = [dict() for _ in range(full+1)]
+        layers[0][bucket(mx_battery)] = [0, mx_battery, None, None, 0]
+        for mask in range(full):
+            for level, state in layers[mask].items():
+                curr_time, curr_battery = state[0], state[1]
+                for k in range(len(path)):
+                    if mask & (1<<k):
+                        continue
+                    if self.is_time_dependent() and mask!=(1<<k)-1:
+                        continue
+                    offsets, duration = timings[k]
+                    for charge, start, battery_left in departure_options(k, curr_time, curr_battery):
+                        if any(start+offset>deadline for offset, deadline in zip(offsets, deadlines[k])):
+                            continue
+                        layer = layers[mask | (1<<k)]
+                        new_state = [start+duration, battery_left, level, k, charge]
+                        old_state = layer.get(bucket(battery_left))
+                        if old_state is None or (new_state[0], -new_state[1]) < (old_state[0], -old_state[1]):
+                            layer[bucket(battery_left)] = new_state
+
+        if len(layers[full])==0:
+            return None
+        level = min(layers[full], key=lambda level: (layers[full][level][0], -layers[full][level][1]))
+        completion_time = layers[full][level][0]
+        ordered_path = []
+        charge_plan = []
+        mask = full
+        while mask:
+            state = layers[mask][level]
+            ordered_path.append(path[state[3]])
+            charge_plan.append(state[4])
+            mask ^= 1<<state[3]
+            level = state[2]
+        return [ordered_path[::-1], charge_plan[::-1], completion_time]
+
+    def path_verifier(self, path):
+        """Checks every limit filtered_paths enforces: weight, battery, deadlines and the chance constraint"""
+        return (self.path_weight_verifier(path) and self.path_battery_verifier(path) and self.path_deadline_bound_verifier(path)
+                and self.path_priority_verifier(path) and self.path_chance_verifier(path))
+
     def path_weight_verifier(self,path):
 
         for pool in path:
@@ -377,6 +771,12 @@ class Delivery:
         return True
 
     def path_battery_verifier(self, path):
+        if self.is_time_dependent():
+            #EVERY POOL MUST FIT IN A FULL BATTERY IN THE FORECAST BUCKET IT ACTUALLY LEAVES IN
+            for battery_required in self.simulate_path(path)[1]:
+                if battery_required + self.drone.emergency_amount_battery > self.drone.max_battery:
+                    return False
+            return True
 
         for pool in path:
             if not self.has_enough_max_battery(pool):
@@ -384,13 +784,88 @@ class Delivery:
         return True
         
     def path_battery_required(self,path):
+        if self.is_time_dependent():
+            #POOL COSTS DEPEND ON WHEN EACH POOL LEAVES THE BASE
+            return sum(self.simulate_path(path)[1])
         total_battery_required = 0
 
         for pool in path:
             total_battery_required += self.battery_required(pool)
         return total_battery_required
 
+    def pool_geometry(self, pool, start_time=0):
+        """Returns the leg geometry of a pool leaving the base at start_time, one entry per leg:
+        fixed (climb and landing) battery, calm cruise battery, unit direction and the nominal wind speed,
+        direction and factor in effect when the leg departs"""
+        key = tuple(id(package) for package in pool)
+        if not self.is_time_dependent() and key in self.pool_geometries:
+            return self.pool_geometries[key]
+        drone = self.drone
+        locations = [self.base] + [package.location for package in pool] + [self.base]
+        load = Delivery.weight_sum(pool)
+        legs = len(locations) - 1
+        fixed, cruise, ux, uy, ws, wd, factor = [np.zeros(legs) for _ in range(7)]
+        time_elapsed = start_time
+        for k in range(legs):
+            curr, nxt = locations[k], locations[k+1]
+            if curr!=nxt:
+                height_to_achieve = self.cruise_height(curr, nxt)
+                fixed[k] = (abs(height_to_achieve - curr.z) * (1+load*(1/self.HEIGHT_CONSTANT)*drone.bcr_rate)*drone.drain_rate*drone.height_rate
+                            + abs(height_to_achieve - nxt.z) * (1+load*(1/self.HEIGHT_CONSTANT)*drone.bcr_rate)*drone.drain_rate*drone.height_rate)
+                distance = Coordinate.distance(curr, nxt)
+                cruise[k] = drone.drain_rate * (1+load*drone.bcr_rate*(1/self.BCR_CONSTANT)) * distance
+                if nxt.x - curr.x==0:
+                    ux[k], uy[k] = 0, 1
+                else:
+                    ux[k], uy[k] = (nxt.x - curr.x)/distance, (nxt.y - curr.y)/distance
+            env = self.env_at(time_elapsed)
+            ws[k], wd[k], factor[k] = env.ws, env.wd, env.factor
+            time_elapsed += self.time_drain(curr, nxt)
+            if k<len(pool):
+                load -= pool[k].weight
+        geometry = (fixed, cruise, ux, uy, ws, wd, factor)
+        if not self.is_time_dependent():
+            self.pool_geometries[key] = geometry
+        return geometry
+
+    def pool_battery_samples(self, pool, start_time=0):
+        """Returns the battery a pool leaving the base at start_time uses under every wind sample of the ensemble"""
+        fixed, cruise, ux, uy, ws, wd, factor = self.pool_geometry(pool, start_time)
+        if not self.setenv:
+            return np.full(len(self.wind_ensemble), fixed.sum() + cruise.sum())
+        return fixed.sum() + self.wind_ensemble.wind_factors(ux, uy, ws, wd, factor) @ cruise
+
+    def trip_breaches(self, path):
+        """Returns a samples x trips boolean array, True where a trip flown under that wind sample needs more than
+        the maximum battery less the emergency reserve, so even a full charge would breach the reserve"""
+        drone = self.drone
+        breaches = np.zeros((len(self.wind_ensemble), len(path)), dtype=bool)
+        if self.is_time_dependent():
+            package_time_list = self.simulate_path(path)[0]
+        k = 0
+        for i, pool in enumerate(path):
+            departure = 0
+            if self.is_time_dependent():
+                departure = package_time_list[k][1] - self.time_drain(self.base, pool[0].location)
+            k += len(pool)
+            breaches[:, i] = self.pool_battery_samples(pool, departure) + drone.emergency_amount_battery>drone.max_battery
+        return breaches
+
+    def breach_probability(self, path):
+        """Returns the probability that at least one trip of a path breaches the emergency reserve"""
+        if len(path)==0:
+            return 0.0
+        return float(self.trip_breaches(path).any(axis=1).mean())
+
+    def path_chance_verifier(self, path):
+        """Checks the chance constraint: the path breaches the emergency reserve with probability at most breach_tolerance"""
+        if self.breach_tolerance is None:
+            return True
+        return self.breach_probability(path)<=self.breach_tolerance
+
     def minimum_battery_path_index(self, all_paths):
+        if len(all_paths)==0:
+            return None
     
         min_battery = 10e7
         min_index = 0
@@ -407,7 +882,7 @@ class Delivery:
         verified_paths = all_paths.copy()
         while i<len(verified_paths):
             cp = verified_paths[i]
-            if self.path_weight_verifier(cp) and self.path_battery_verifier(cp) and self.path_priority_verifier(cp):
+            if self.path_verifier(cp):
                 i+=1
                 continue
             else:
@@ -416,6 +891,88 @@ class Delivery:
         if len(verified_paths)==0:
             print("No paths satisfy conditions")
         return verified_paths
+    def scheduled_paths(self, canonical_paths):
+        """Filters canonical paths like filtered_paths, ordering the pools of every kept path so it meets its deadlines"""
+        verified_paths = []
+        if self.kernel is not None and not self.is_time_dependent() and len(canonical_paths)>0:
+            packages = [package for pool in canonical_paths[0] for package in pool]
+            limits_met = self.kernel_path_verifier(canonical_paths, packages)
+        elif self.workers>1 and not self.is_time_dependent() and len(canonical_paths)>self.SHARD_SIZE:
+            packages = [package for pool in canonical_paths[0] for package in pool]
+            limits_met = self.parallel_path_verifier(canonical_paths, packages)
+        else:
+            limits_met = [self.path_weight_verifier(path) and self.path_battery_verifier(path) for path in canonical_paths]
+        for path, limit_met in zip(canonical_paths, limits_met):
+            if limit_met:
+                ordered_path = self.feasible_pool_order(path)
+                if ordered_path is not None and self.path_chance_verifier(ordered_path):
+                    verified_paths.append(ordered_path)
+
+        if len(verified_paths)==0:
+            print("No paths satisfy conditions")
+        return verified_paths
+
+    def parallel_path_verifier(self, paths, packages):
+        """Runs the weight and battery checks of many paths in worker processes
+        The batch is compiled once into a SharedProblem; workers receive only its spec and integer-encoded shards"""
+        problem = SharedProblem.create(self, packages)
+        positions = {id(package): i for i, package in enumerate(packages)}
+        encoded = [[[positions[id(package)] for package in pool] for pool in path] for path in paths]
+        shards = [encoded[i:i+self.SHARD_SIZE] for i in range(0, len(encoded), self.SHARD_SIZE)]
+        try:
+            with ProcessPoolExecutor(self.workers) as executor:
+                results = executor.map(evaluate_shard, [problem.spec]*len(shards), shards)
+                return list(chain.from_iterable(results))
+        finally:
+            problem.close()
+            problem.unlink()
+
+    def kernel_arrays(self, packages):
+        """Returns the first forecast bucket of the leg tables and the package weights of a batch,
+        as arrays for the numba kernels and as lists for the Python ones"""
+        leg_table = self.build_leg_tables(packages)
+        fixed, per_load = leg_table.fixed[0], leg_table.per_load[0]
+        weights = [float(package.weight) for package in packages]
+        if self.kernel=='numba' and np is not None:
+            return np.array(fixed, dtype=float), np.array(per_load, dtype=float), np.array(weights)
+        return fixed, per_load, weights
+
+    def encode_paths(self, paths, packages):
+        """Flattens paths into package positions in packages, the start of every pool in positions
+        and the start of every path in the pool starts, each list closed by its total length"""
+        index = {id(package): i for i, package in enumerate(packages)}
+        positions, pool_starts, path_starts = [], [0], [0]
+        for path in paths:
+            for pool in path:
+                positions.extend(index[id(package)] for package in pool)
+                pool_starts.append(len(positions))
+            path_starts.append(len(pool_starts) - 1)
+        if self.kernel=='numba' and np is not None:
+            return np.array(positions, dtype=np.int64), np.array(pool_starts, dtype=np.int64), np.array(path_starts, dtype=np.int64)
+        return positions, pool_starts, path_starts
+
+    def kernel_pool_battery(self, pool, packages=None):
+        """Returns the battery of a pool computed by the selected kernel"""
+        if packages is None:
+            packages = pool
+        trip_battery, _ = kernel_backend(self.kernel)
+        fixed, per_load, weights = self.kernel_arrays(packages)
+        positions, pool_starts, _ = self.encode_paths([[pool]], packages)
+        return trip_battery(fixed, per_load, weights, positions, pool_starts[0], pool_starts[1])
+
+    def kernel_path_verifier(self, paths, packages):
+        """Runs the weight and battery checks of many paths in one call to the selected kernel"""
+        _, paths_feasible = kernel_backend(self.kernel)
+        fixed, per_load, weights = self.kernel_arrays(packages)
+        positions, pool_starts, path_starts = self.encode_paths(paths, packages)
+        if self.kernel=='numba' and np is not None:
+            feasible = np.zeros(len(paths), dtype=np.bool_)
+        else:
+            feasible = [False]*len(paths)
+        paths_feasible(fixed, per_load, weights, positions, pool_starts, path_starts, float(self.drone.capacity),
+                       float(self.drone.max_battery - self.drone.emergency_amount_battery), feasible)
+        return [bool(met) for met in feasible]
+
     def minimum_battery_path(self, all_paths):
         min_index= self.minimum_battery_path_index(all_paths)
         if min_index==None:
@@ -428,12 +985,19 @@ class Delivery:
                 
         
     def get_best_path(self, packages):
+        if not self.urgent_batch_feasible(packages):
+            print("No paths satisfy conditions")
+            return []
         
-        all_paths = self.all_possible_paths(packages)
+        if self.is_time_dependent():
+            #POOL COSTS DEPEND ON THE ORDER OF POOLS, EVERY ORDER IS A SEPARATE CANDIDATE
+            all_paths = self.all_possible_paths(packages)
 ##        print("IN HERE FAM")
 ##        print(all_paths)
         
-        filtered_paths = self.filtered_paths(all_paths)
+            filtered_paths = self.filtered_paths(all_paths)
+        else:
+            filtered_paths = self.scheduled_paths(self.canonical_paths(packages))
         print(filtered_paths)
 ##        for path in filtered_paths:
 ##            print(self.path_battery_required(path))
@@ -443,6 +1007,565 @@ class Delivery:
         
         return best_path
         
+    def path_objectives(self, path):
+        """Returns (total battery, completion time, weighted lateness) of a path"""
+        package_time_list, pool_battery_list, completion_time = self.simulate_path(path)
+        lateness = 0
+        for package, time in package_time_list:
+            lateness += self.lateness_weights[package.priority] * max(0, time - self.priority_dict[package.priority])
+        return (sum(pool_battery_list), completion_time, lateness)
+
+    def pareto_paths(self, packages):
+        """Returns a ParetoArchive of the paths that are not dominated in battery, completion time and weighted lateness
+        Deadlines are an objective here, so only the weight and battery limits filter paths"""
+        archive = ParetoArchive()
+        for path in self.all_possible_paths(packages.copy()):
+            if self.path_weight_verifier(path) and self.path_battery_verifier(path):
+                archive.add(self.path_objectives(path), path)
+        return archive
+
+    def plan(self, packages, cancel=None):
+        """Returns the best path found by the selected planner, group by group if cluster is set
+        cancel (e.g. a threading.Event) stops the 'partition' and 'anytime' searches early; brute force runs to the end
+        With a plan_cache, a batch planned before is answered from the cache; only searches that ran to the end are
+        stored, not ones cut short by cancel or time_budget
+        Every plan is reported in plan_report with its gap to lower_bound(), or no gap if the search ran to the end
+        and so proved it optimal"""
+        start = time.monotonic()
+        cancelled = lambda: cancel is not None and cancel.is_set()
+        path = None
+        #ONLY FINISHED SEARCHES ARE CACHED
+        complete = True
+        if self.plan_cache is not None:
+            key = self.problem_fingerprint(packages)
+            cached = self.plan_cache.get(key)
+            if cached is not None:
+                path = self.decode_plan(cached, packages)
+        if path is None:
+            if self.cluster:
+                path, complete = self.clustered_plan(packages, cancel)
+            else:
+                path, complete = self.run_planner(packages, cancel)
+            complete = complete and not cancelled()
+            if self.plan_cache is not None and complete:
+                self.plan_cache.put(key, self.encode_plan(path))
+        self.plan_report = None
+        if len(path)>0:
+            battery = self.path_battery_required(path)
+            bound = battery if complete else min(self.lower_bound(packages), battery)
+            self.plan_report = PlanUpdate(path, battery, bound, time.monotonic() - start, complete)
+        return path
+
+    def run_planner(self, packages, cancel=None):
+        """Returns [the best path the selected planner finds for the whole batch, whether its search ran to the end]
+        A search that ran to the end proved its path optimal, or that there is none"""
+        checkpoint = self.checkpoint_file(packages)
+        cancelled = lambda: cancel is not None and cancel.is_set()
+        planners = {'bruteforce': lambda packages: [self.get_best_path(packages), True],
+                    'partition': lambda packages: [self.partition_best_path(packages, cancel, checkpoint), not cancelled()],
+                    'anytime': lambda packages: self.anytime_best_path(packages, cancel, checkpoint),
+                    'milp': lambda packages: self.milp_best_path(packages, self.time_budget),
+                    'audit': lambda packages: self.audit_best_path(packages, checkpoint=checkpoint)}
+        if self.planner not in planners:
+            raise Exception(f'Unknown planner {self.planner}')
+        return planners[self.planner](packages)
+
+    async def plan_async(self, executor=None):
+        """Plans best_path without blocking the event loop by running the search in an executor
+        Requests share planning_executor() unless another executor is given (a ProcessPoolExecutor works too)
+        Cancelling the awaiting task stops a thread-run 'partition' or 'anytime' search"""
+        loop = asyncio.get_running_loop()
+        if executor is None:
+            executor = planning_executor()
+        packages = self.remaining_packages.copy()
+        #AN EVENT ONLY REACHES THREADS, PROCESS WORKERS RUN UNTIL THEIR SEARCH ENDS
+        cancel = threading.Event() if isinstance(executor, ThreadPoolExecutor) else None
+        try:
+            encoded_path = await loop.run_in_executor(executor, plan_worker, self, packages, cancel)
+        except asyncio.CancelledError:
+            if cancel is not None:
+                cancel.set()
+            raise
+        #WORKERS RETURN POSITIONS, SO PATHS FROM ANOTHER PROCESS MAP BACK TO THESE PACKAGES
+        self.best_path = [[packages[i] for i in pool] for pool in encoded_path]
+        self.apply_charge_schedule()
+        return self.best_path
+
+    def package_clusters(self, packages):
+        """Splits packages into groups no trip can mix, keeping their order
+        Union-find joins two packages if they fit one trip, within capacity and with enough maximum battery in
+        either order; the groups are the connected components, so a trip only mixes packages of one group as long
+        as dropping a stop never makes a trip heavier or costlier"""
+        parent = list(range(len(packages)))
+
+        def find(i):
+            while parent[i]!=i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j in combinations(range(len(packages)), 2):
+            first, second = packages[i], packages[j]
+            if find(i)==find(j) or first.weight + second.weight>self.drone.capacity:
+                continue
+            if self.has_enough_max_battery([first, second]) or self.has_enough_max_battery([second, first]):
+                parent[find(i)] = find(j)
+        groups = dict()
+        for i, package in enumerate(packages):
+            groups.setdefault(find(i), []).append(package)
+        return list(groups.values())
+
+    def checkpoint_file(self, packages):
+        """Returns the file a search over packages checkpoints to, one per group when the batch is clustered"""
+        if self.checkpoint is None or not self.cluster:
+            return self.checkpoint
+        return f'{self.checkpoint}.{self.problem_fingerprint(packages)[:16]}'
+
+    def read_checkpoint(self, checkpoint, fingerprint):
+        """Returns the search state saved in checkpoint, None if there is no such file yet"""
+        if checkpoint is None or not os.path.exists(checkpoint):
+            return None
+        with open(checkpoint) as file:
+            state = json.load(file)
+        if state['fingerprint']!=fingerprint:
+            raise Exception(f'{checkpoint} belongs to another problem')
+        return state
+
+    def write_checkpoint(self, checkpoint, state):
+        """Saves a search state to checkpoint, through a temporary file so a worker killed mid-write leaves the last one"""
+        temporary = checkpoint + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(state, file)
+        os.replace(temporary, checkpoint)
+
+    def canonical_order(packages):
+        """Returns the packages in an order fixed by their fingerprints, so saved indexes and masks mean the same
+        packages whatever order a resumed batch comes in"""
+        return sorted(packages, key=lambda package: repr(Delivery.package_fingerprint(package)))
+
+    def clustered_plan(self, packages, cancel=None):
+        """Plans every package cluster on its own, in worker processes if workers>1, and stitches the trips into one
+        path ordered to meet the deadlines; falls back to planning the whole batch if the stitched trips cannot be,
+        or if together they breach the emergency reserve more often than breach_tolerance allows
+        Under a WindForecast the cost of a pool depends on when it leaves, so the groups are not independent and the
+        whole batch is planned at once
+        Returns [path, whether every search ran to the end] like run_planner"""
+        groups = self.package_clusters(packages)
+        if len(groups)<=1 or self.is_time_dependent():
+            return self.run_planner(packages, cancel)
+        if self.workers>1:
+            with ProcessPoolExecutor(self.workers) as executor:
+                results = list(executor.map(search_worker, [self]*len(groups), groups))
+            results = [[[[group[i] for i in pool] for pool in encoded_path], complete]
+                       for group, (encoded_path, complete) in zip(groups, results)]
+        else:
+            results = [self.run_planner(group, cancel) for group in groups]
+        paths = [path for path, _ in results]
+        complete = all(complete for _, complete in results)
+        if any(len(path)==0 for path in paths):
+            return [[], complete]
+        path = self.feasible_pool_order([pool for path in paths for pool in path])
+        #EVERY GROUP WAS PLANNED FROM TIME 0 AND ON ITS OWN, TOGETHER THEIR DEADLINES AND BREACHES ADD UP
+        if path is None or not self.path_chance_verifier(path):
+            return self.run_planner(packages, cancel)
+        return [path, complete]
+
+    def feasible_pool_order(self, pools):
+        """Returns an order of the pools that meets every deadline, trying deadline-first order before the others, or None"""
+        for path in chain([self.edd_order(pools)], permutations(pools)):
+            path = list(path)
+            if self.path_deadline_bound_verifier(path) and self.path_priority_verifier(path):
+                return path
+        return None
+
+    def schedule_partition(self, pools, bound):
+        """Returns a path delivering the given pools that meets the deadlines and the chance constraint, or None
+        The cheapest order of every pool is tried first; if either binds, costlier orders below bound are tried next
+        (in a fixed environment the breach probability depends on the orders within the pools, not on the pool order)"""
+        path = self.feasible_pool_order(pools)
+        if path is not None and self.path_chance_verifier(path):
+            return path
+        candidates = []
+        for orders in product(*[permutations(pool) for pool in pools]):
+            orders = [list(order) for order in orders]
+            batteries = [self.battery_required(order) for order in orders]
+            #A COSTLIER ORDER MAY NO LONGER FIT THE BATTERY
+            if max(batteries) + self.drone.emergency_amount_battery>self.drone.max_battery:
+                continue
+            battery = sum(batteries)
+            if battery<bound:
+                candidates.append([battery, orders])
+        candidates.sort(key=lambda candidate: candidate[0])
+        for battery, orders in candidates:
+            path = self.feasible_pool_order(orders)
+            if path is not None and self.path_chance_verifier(path):
+                return path
+        return None
+
+    def timed_partition_path(self, pools, bound):
+        """Returns the cheapest path below bound delivering the given pools under a WindForecast, or None
+        Pool costs depend on when each pool leaves, so every order of the pools and of the packages in them is
+        checked like filtered_paths checks the brute force candidates"""
+        best_path = None
+        for orders in product(*[permutations(pool) for pool in pools]):
+            for path in permutations(orders):
+                path = [list(order) for order in path]
+                if not self.path_verifier(path):
+                    continue
+                battery = self.path_battery_required(path)
+                if battery<bound:
+                    best_path, bound = path, battery
+        return best_path
+
+    def partition_trips(self, trip_index):
+        """Returns the feasible trip masks grouped by their lowest package, cheapest first"""
+        trips_by_low = [[] for _ in trip_index.packages]
+        for mask in trip_index.trips:
+            trips_by_low[(mask & -mask).bit_length()-1].append(mask)
+        for masks in trips_by_low:
+            masks.sort(key=lambda mask: trip_index.trips[mask][1])
+        return trips_by_low
+
+    def partition_best_path(self, packages, cancel=None, checkpoint=None):
+        """Finds the minimum battery path by partitioning the packages into feasible trips, resuming from checkpoint if given"""
+        if not self.urgent_batch_feasible(packages):
+            print("No paths satisfy conditions")
+            return []
+        best_path = None
+        for path, battery in self.partition_search(packages, cancel=cancel, checkpoint=checkpoint):
+            best_path = path
+        if best_path is None:
+            print("No paths satisfy conditions")
+            return []
+        return best_path
+
+    def partition_search(self, packages, deadline=None, cancel=None, checkpoint=None, incumbent=None):
+        """Yields [path, battery] every time the partition search finds a cheaper deadline-feasible path,
+        and returns True if the search space was exhausted
+        Outer level: every partition of the packages into trips of the TripIndex, the lowest unassigned package
+        always opening the next trip so each partition is generated once, with branch and bound on battery
+        A branch is pruned once its cost plus the trip shares of the packages left reaches the best battery
+        Inner level: every trip uses its best order from the index, looked up instead of permuted
+        Under a WindForecast the index only bounds trip costs, so every partition left after pruning is priced exactly
+        by timed_partition_path
+        The search stops early once time.monotonic() passes deadline, even while the TripIndex is built, or cancel
+        (e.g. a threading.Event) is set; an incumbent [path, battery] found beforehand only prunes, it is not yielded
+        With a checkpoint file, the incumbent and the frontier (the trips chosen so far and the next trip to try at every
+        depth) are saved every CHECKPOINT_INTERVAL seconds, when the search stops and when it ends; a search over the
+        same problem_fingerprint() resumes from the file, yielding its incumbent first"""
+        trip_index = self.get_trip_index(packages, deadline)
+        if checkpoint is not None and trip_index.complete:
+            #MASKS IN THE FILE REFER TO PACKAGES IN A FIXED ORDER
+            order = Delivery.canonical_order(trip_index.packages)
+            if [id(package) for package in order]!=[id(package) for package in trip_index.packages]:
+                trip_index = self.build_trip_index(order, deadline)
+        if not trip_index.complete:
+            return False
+        if len(trip_index.packages)==0:
+            if incumbent is None:
+                yield [[], 0]
+            return True
+        trips_by_low = self.partition_trips(trip_index)
+        shares = self.trip_shares(trip_index)
+        best = [[], 10e7] if incumbent is None else list(incumbent)
+
+        def remaining_bound(remaining):
+            bound = 0
+            while remaining:
+                low = remaining & -remaining
+                bound += shares[low.bit_length()-1]
+                remaining ^= low
+            return bound
+
+        #EVERY FRAME IS [PACKAGES LEFT, COST SO FAR, NEXT TRIP TO TRY], chosen HOLDS THE TRIP LEADING TO EVERY FRAME BUT THE FIRST
+        stack = [[(1<<len(trip_index.packages))-1, 0, 0]]
+        chosen = []
+        if checkpoint is not None:
+            fingerprint = self.problem_fingerprint(trip_index.packages)
+            state = self.read_checkpoint(checkpoint, fingerprint)
+            if state is not None:
+                if state['best'] is not None and state['battery']<best[1]:
+                    best = [self.decode_plan(state['best'], trip_index.packages), state['battery']]
+                    yield list(best)
+                chosen = state['chosen']
+                stack = []
+                remaining, cost = (1<<len(trip_index.packages))-1, 0
+                for k, position in enumerate(state['positions']):
+                    stack.append([remaining, cost, position])
+                    if k<len(chosen):
+                        remaining, cost = remaining ^ chosen[k], cost + trip_index.trips[chosen[k]][1]
+
+            def save():
+                self.write_checkpoint(checkpoint, {'fingerprint': fingerprint,
+                                                   'best': self.encode_plan(best[0]) if best[1]<10e7 else None,
+                                                   'battery': best[1], 'chosen': chosen,
+                                                   'positions': [frame[2] for frame in stack]})
+            next_save = time.monotonic() + self.CHECKPOINT_INTERVAL
+
+        stopped = False
+        while stack:
+            if (deadline is not None and time.monotonic()>deadline) or (cancel is not None and cancel.is_set()):
+                stopped = True
+                break
+            if checkpoint is not None and time.monotonic()>=next_save:
+                save()
+                next_save = time.monotonic() + self.CHECKPOINT_INTERVAL
+            frame = stack[-1]
+            remaining, cost, position = frame
+            if remaining==0:
+                if self.is_time_dependent():
+                    path = self.timed_partition_path([trip_index.packages_of(mask) for mask in chosen], best[1])
+                else:
+                    path = self.schedule_partition([trip_index.trips[mask][0] for mask in chosen], best[1])
+                stack.pop()
+                chosen.pop()
+                if path is not None and self.path_chance_verifier(path):
+                    battery = self.path_battery_required(path)
+                    if battery<best[1]:
+                        best[0], best[1] = path, battery
+                        yield [path, battery]
+                continue
+            trips = trips_by_low[(remaining & -remaining).bit_length()-1]
+            child = None
+            while position<len(trips):
+                mask = trips[position]
+                position += 1
+                if mask & ~remaining:
+                    continue
+                new_cost = cost + trip_index.trips[mask][1]
+                if new_cost>=best[1]:
+                    #TRIPS ARE SORTED BY BATTERY, NONE LEFT IS CHEAPER
+                    position = len(trips)
+                    break
+                if new_cost + remaining_bound(remaining ^ mask)>=best[1]:
+                    continue
+                child = mask
+                break
+            frame[2] = position
+            if child is None:
+                stack.pop()
+                if chosen:
+                    chosen.pop()
+            else:
+                chosen.append(child)
+                stack.append([remaining ^ child, cost + trip_index.trips[child][1], 0])
+        if checkpoint is not None:
+            save()
+        return not stopped
+
+    def trip_shares(self, trip_index):
+        """Returns, for every package, the cheapest per-package share (battery / size) of a feasible trip containing it,
+        10e7 if no trip does"""
+        shares = [10e7]*len(trip_index.packages)
+        for mask, trip in trip_index.trips.items():
+            share = trip[1]/len(trip[0])
+            for i in range(len(shares)):
+                if mask & (1<<i) and share<shares[i]:
+                    shares[i] = share
+        return shares
+
+    def trip_share_bound(self, trip_index):
+        """Returns a lower bound on the battery of any plan: every package pays at least the cheapest
+        per-package share (battery / size) of a feasible trip containing it"""
+        return min(sum(self.trip_shares(trip_index)), 10e7)
+
+    def lower_bound(self, packages):
+        """Returns a geometric lower bound on the battery of any plan delivering packages, from three parts of
+        battery_drain that add up:
+        - cruise without load: the trips connect the base and every location, so they fly at least the minimum spanning
+          tree, at the lowest wind factor exp(-ws * factor) of any bucket
+        - climb and landing without load: every leg rises at least altitude and lands at least altitude; there is a leg
+          into every distinct location and one back to base per trip, and there are at least total weight / capacity trips
+        - load: every package is carried at least the straight line from the base to it, and through at least its
+          height above the base plus altitude up and altitude down"""
+        if len(packages)==0:
+            return 0
+        drone = self.drone
+        base = self.base
+        locations = list({id(package.location): package.location for package in packages}.values())
+        wind_factor = 1
+        if self.setenv:
+            wind_factor = min(math.exp(env.ws * env.factor * -1) for env in self.env_buckets())
+        altitude = max(drone.altitude, 0)
+
+        #PRIM'S ALGORITHM OVER THE BASE AND THE DISTINCT LOCATIONS
+        tree = 0
+        nearest = [Coordinate.distance(base, location) for location in locations]
+        while len(nearest)>0:
+            k = min(range(len(nearest)), key=nearest.__getitem__)
+            tree += nearest[k]
+            joined = locations[k]
+            del nearest[k], locations[k]
+            nearest = [min(distance, Coordinate.distance(joined, location)) for distance, location in zip(nearest, locations)]
+
+        trips = math.ceil(Delivery.weight_sum(packages) / drone.capacity)
+        legs = len({id(package.location) for package in packages}) + max(trips, 1)
+        bound = drone.drain_rate * wind_factor * tree + legs * 2 * altitude * drone.drain_rate * drone.height_rate
+        for package in packages:
+            carried = drone.drain_rate * drone.bcr_rate * (1/self.BCR_CONSTANT) * wind_factor * Coordinate.distance(base, package.location)
+            carried += (abs(package.location.z - base.z) + 2 * altitude) * drone.drain_rate * drone.height_rate * drone.bcr_rate * (1/self.HEIGHT_CONSTANT)
+            bound += package.weight * carried
+        return bound
+
+    def iter_plans(self, packages, time_budget=None, cancel=None, checkpoint=None):
+        """Anytime planning: yields a PlanUpdate for every improving plan found within time_budget seconds
+        The first update is a heuristic plan (greedy trips, or one trip per package) when one meets every limit, so
+        a plan is out before the TripIndex is built; the budget also covers building it
+        A last update with optimal=True is yielded if the search finishes, so the dispatcher can stop
+        consuming at any point and keep the latest plan"""
+        start = time.monotonic()
+        deadline = None if time_budget is None else start + time_budget
+        if not self.urgent_batch_feasible(packages):
+            return
+        bound = self.lower_bound(packages)
+        best = self.heuristic_plan(packages)
+        if best is not None:
+            yield PlanUpdate(best[0], best[1], min(bound, best[1]), time.monotonic() - start, False)
+        trip_index = self.get_trip_index(packages, deadline)
+        if trip_index.complete:
+            bound = max(self.trip_share_bound(trip_index), bound)
+        search = self.partition_search(packages, deadline, cancel, checkpoint, best)
+        while True:
+            try:
+                path, battery = next(search)
+            except StopIteration as stop:
+                completed = stop.value
+                break
+            best = [path, battery]
+            yield PlanUpdate(path, battery, min(bound, battery), time.monotonic() - start, False)
+        if completed and best is not None:
+            yield PlanUpdate(best[0], best[1], best[1], time.monotonic() - start, True)
+
+    def heuristic_plan(self, packages):
+        """Returns [path, battery] of the first of the greedy trips and one trip per package that meets every limit
+        in deadline-first order, or None; the trips are not reordered further, so this stays cheap"""
+        for pools in [self.greedy_pools(packages), [[package] for package in packages]]:
+            path = self.edd_order(pools)
+            if self.path_verifier(path):
+                return [path, self.path_battery_required(path)]
+        return None
+
+    def anytime_best_path(self, packages, cancel=None, checkpoint=None):
+        """Returns [the best path found within time_budget seconds, whether the search ran to the end]"""
+        best = [[], False]
+        for update in self.iter_plans(packages, self.time_budget, cancel, checkpoint):
+            best = [update.path, update.optimal]
+        return best
+
+    def plan_anytime(self, packages, time_budget=None, callback=None, cancel=None, checkpoint=None):
+        """Returns the best path found within time_budget seconds, calling callback with every PlanUpdate"""
+        best_path = []
+        for update in self.iter_plans(packages, time_budget, cancel, checkpoint):
+            best_path = update.path
+            if callback is not None:
+                callback(update)
+        return best_path
+
+    def greedy_path(self, packages):
+        """Heuristic plan: the trips of greedy_pools(), or [] if they cannot be ordered to meet the deadlines"""
+        path = self.feasible_pool_order(self.greedy_pools(packages))
+        return [] if path is None else path
+
+    def greedy_pools(self, packages):
+        """Returns heuristic trips: every trip opens with the most urgent, then farthest, remaining package and keeps
+        adding the package that raises its battery least while it stays within capacity and battery"""
+        remaining = sorted(packages, key=lambda package: (self.priority_dict[package.priority], -self.time_drain(self.base, package.location)))
+        pools = []
+        while len(remaining)>0:
+            pool = [remaining.pop(0)]
+            while True:
+                best = None
+                for package in remaining:
+                    candidate = pool + [package]
+                    if Delivery.weight_sum(candidate)>self.drone.capacity or not self.has_enough_max_battery(candidate):
+                        continue
+                    battery = self.battery_required(candidate)
+                    if best is None or battery<best[0]:
+                        best = (battery, package)
+                if best is None:
+                    break
+                pool.append(best[1])
+                remaining.remove(best[1])
+            pools.append(pool)
+        return pools
+
+    def milp_best_path(self, packages, time_limit=None):
+        """Finds the minimum battery path with a set-partitioning MILP solved by CBC (through PuLP)
+        Every feasible trip of the TripIndex (within capacity, battery from the affine leg costs) is a binary column
+        costing its battery, and every package is covered by exactly one chosen trip. The chosen trips are then
+        scheduled to meet the deadlines and the chance constraint; as that can fail or cost more, every partition tried
+        is cut off and the model solved again until its optimum is no better than the best schedule found
+        The solver is warm-started from heuristic_plan() and stops after time_limit seconds, which also cover building
+        the TripIndex and the model; if they take it all, the heuristic plan is returned
+        Returns [the best path found, or [], whether CBC proved it optimal (or that there is none)]"""
+        if pulp is None:
+            raise ImportError('pulp is required for the milp planner')
+        if self.is_time_dependent():
+            raise Exception('The milp planner needs a fixed environment')
+        if len(packages)==0:
+            return [[], True]
+        if not self.urgent_batch_feasible(packages):
+            print("No paths satisfy conditions")
+            return [[], True]
+        start = time.monotonic()
+        deadline = None if time_limit is None else start + time_limit
+        expired = lambda: deadline is not None and time.monotonic()>deadline
+        best = self.heuristic_plan(packages) or [[], 10e7]
+        trip_index = self.get_trip_index(packages, deadline)
+        if not trip_index.complete:
+            return [best[0], False]
+        model = pulp.LpProblem('drone_delivery', pulp.LpMinimize)
+        chosen = {mask: pulp.LpVariable(f'trip_{mask}', cat='Binary') for mask in trip_index.trips}
+        model += pulp.lpSum(trip[1] * chosen[mask] for mask, trip in trip_index.trips.items())
+        #ONE PASS OVER THE SET BITS OF EVERY TRIP INSTEAD OF ONE PASS OVER ALL TRIPS PER PACKAGE
+        covers = [[] for _ in trip_index.packages]
+        for mask, var in chosen.items():
+            remaining = mask
+            while remaining:
+                low = remaining & -remaining
+                covers[low.bit_length()-1].append(var)
+                remaining ^= low
+        for cover in covers:
+            model += pulp.lpSum(cover)==1
+        if expired():
+            return [best[0], False]
+
+        if len(best[0])>0:
+            for var in chosen.values():
+                var.setInitialValue(0)
+            for pool in best[0]:
+                chosen[trip_index.mask_of(pool)].setInitialValue(1)
+        proven = False
+        while True:
+            remaining_time = None if time_limit is None else time_limit - (time.monotonic() - start)
+            if remaining_time is not None and remaining_time<=0:
+                break
+            solver = pulp.PULP_CBC_CMD(msg=False, warmStart=len(best[0])>0,
+                                       timeLimit=None if remaining_time is None else max(1, int(remaining_time)))
+            model.solve(solver)
+            if model.sol_status not in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible):
+                #EVERY PARTITION IS CUT OFF OR NONE EXISTS; OTHERWISE THE TIME LIMIT STOPPED CBC FIRST
+                proven = model.sol_status==pulp.LpSolutionInfeasible
+                break
+            optimal = model.sol_status==pulp.LpSolutionOptimal
+            if optimal and pulp.value(model.objective)>=best[1] - 1e-9:
+                proven = True
+                break
+            masks = [mask for mask, var in chosen.items() if var.value()>0.5]
+            path = self.schedule_partition([trip_index.trips[mask][0] for mask in masks], best[1])
+            if path is not None:
+                battery = self.path_battery_required(path)
+                if battery<best[1]:
+                    best[0], best[1] = path, battery
+                if optimal and battery<=pulp.value(model.objective) + 1e-9:
+                    proven = True
+                    break
+            #THIS PARTITION IS SCHEDULED (OR CANNOT BE), CUT IT OFF
+            model += pulp.lpSum(chosen[mask] for mask in masks)<=len(masks) - 1
+        if len(best[0])==0:
+            print("No paths satisfy conditions")
+        return [best[0], proven]
+
     def weight_sum(package_list):
         """Returns the total weight of packages in a package list"""
         weight_total = 0
@@ -464,50 +1587,54 @@ class Delivery:
             self.drone.unload_package(package)
 
     def package_order(self, packages):
-        """Returns the order in which packages will be delivered"""
-        def sub_lists(my_list):
-            subs = []
-            for i in range(0, len(my_list)+1):
-              temp = [list(x) for x in combinations(my_list, i)]
-              if len(temp)>0:
-                subs.extend(temp)
-            subs.remove([])
-            
-            return subs
-
-        def order_sublist(l):
-            """Returns a dictionary in which the possible orders are organised based on the number of packages"""
-            # {1: [[10], [11], [12]], 2: [[10, 11], [11, 10]]}
-            capacity = self.drone.capacity
-            packages_dictionary = dict()
-
-            for temp_list in l:
-                if Delivery.weight_sum(temp_list) > capacity:
-                    continue
-
-                if not self.has_enough_max_battery(temp_list):
-                    continue
-
-                if len(temp_list) not in packages_dictionary:
-                    packages_dictionary[len(temp_list)] = [temp_list]
-                else:
-                    packages_dictionary[len(temp_list)].append(temp_list)
-
-            return packages_dictionary
-        
-        return order_sublist(sub_lists(packages))
+        """Returns a dictionary in which the feasible pools are organised based on the number of packages"""
+        # {1: [[10], [11], [12]], 2: [[10, 11], [11, 12]]}
+        trip_index = self.get_trip_index(packages)
+        packages_dictionary = dict()
+        for mask in sorted(trip_index.trips):
+            pool = trip_index.packages_of(mask)
+            if len(pool) not in packages_dictionary:
+                packages_dictionary[len(pool)] = [pool]
+            else:
+                packages_dictionary[len(pool)].append(pool)
+        return packages_dictionary
+
+    def build_trip_index(self, packages, deadline=None):
+        """Returns a TripIndex of every capacity and battery feasible pool of packages with its best order,
+        incomplete if time.monotonic() passes deadline first"""
+        return TripIndex(self, packages, deadline)
+
+    def get_trip_index(self, packages, deadline=None):
+        """Returns the TripIndex of a batch, building it once per set of packages (an incomplete index is not kept)"""
+        key = frozenset(id(package) for package in packages)
+        if key in self.trip_indexes:
+            return self.trip_indexes[key]
+        trip_index = self.build_trip_index(packages, deadline)
+        if trip_index.complete:
+            self.trip_indexes[key] = trip_index
+        return trip_index
+
+    def cruise_height(self, curr, nxt):
+        """Returns the height a leg cruises at: altitude above the higher end of the leg, or above the highest
+        terrain along it if that is higher"""
+        height = max(curr.z, nxt.z)
+        if self.terrain is not None:
+            height = max(height, self.terrain.peak(curr, nxt))
+        return height + self.drone.altitude
 
     def height_drain(self, curr_height, nxt_height, curr_load, drain_rate, height_rate,bcr_rate):
         
         return abs(curr_height - nxt_height) * (1 + curr_load * bcr_rate*(1/self.HEIGHT_CONSTANT)) * drain_rate * height_rate
 
-    def battery_drain(self, curr_location, location_to_go, curr_load, drain_rate, bcr_rate,height_rate):
+    def battery_drain(self, curr_location, location_to_go, curr_load, drain_rate, bcr_rate,height_rate,env=None):
             """Returns the amount of battery consumed by delivering a given list of packages"""
             if curr_location == location_to_go:
                 return 0
+            if env is None:
+                env = self.env_at(0)
             
             drain = 0
-            height_to_achieve = max(curr_location.z,location_to_go.z) + self.drone.altitude
+            height_to_achieve = self.cruise_height(curr_location, location_to_go)
             #HEIGHT DRAIN
             drain += abs(height_to_achieve - curr_location.z) * (1+curr_load*(1/self.HEIGHT_CONSTANT)*bcr_rate)*drain_rate*height_rate
                         
@@ -522,9 +1649,9 @@ class Delivery:
                     
                     direction_vector = Coordinate(DV_x/DV_mag, DV_y/DV_mag)
 
-                DP = Coordinate.dot_product(direction_vector, self.env.vec)
+                DP = Coordinate.dot_product(direction_vector, env.vec)
                
-                wind_factor = math.exp(self.env.ws * self.env.factor * DP * -1)
+                wind_factor = math.exp(env.ws * env.factor * DP * -1)
             else:
                 #ELSE NO EFFECT
                 wind_factor = 1
@@ -586,7 +1713,9 @@ class Delivery:
 ##        return required
 
     
-    def battery_required(self,packages,debug=False,values=[]):
+    def battery_required(self,packages,debug=False,values=[],start_time=0):
+        if self.is_time_dependent():
+            return self.timed_battery_required(packages,start_time)
         
         total_drain = 0
         drain_rate = self.drone.drain_rate
@@ -614,6 +1743,24 @@ class Delivery:
         required+=return_required
         return required
 
+    def timed_battery_required(self, packages, start_time=0):
+        """Returns the battery required for a pool leaving the base at start_time, using the forecast
+        bucket in effect at the departure of every leg"""
+        leg_table = self.get_leg_table()
+        required = 0
+        time_elapsed = start_time
+        curr_weight = Delivery.weight_sum(packages)
+        curr = self.base
+
+        for package in packages:
+            nxt = package.location
+            required += leg_table.drain(self, curr, nxt, curr_weight, time_elapsed)
+            time_elapsed += leg_table.leg_time(self, curr, nxt)
+            curr_weight -= package.weight
+            curr = nxt
+        required += leg_table.drain(self, curr, self.base, 0, time_elapsed)
+        return required
+
     def time_required(self, packages):
         pass
 
@@ -624,7 +1771,7 @@ class Delivery:
         time_elapsed = 0
         speed = self.drone.speed
         takeoff_rate = self.drone.takeoff_rate
-        height_to_achieve = max(curr.z, nxt.z) + self.drone.altitude
+        height_to_achieve = self.cruise_height(curr, nxt)
 
         time_elapsed += abs(height_to_achieve-curr.z) / takeoff_rate
 
@@ -638,9 +1785,9 @@ class Delivery:
         
        
         
-    def has_enough_battery(self, packages):
+    def has_enough_battery(self, packages, start_time=0):
         """Checks whether the drone has enough battery to deliver a given list of packages (within the weight limit)"""
-        if self.battery_required(packages) + self.drone.emergency_amount_battery> self.drone.current_battery():
+        if self.battery_required(packages,start_time=start_time) + self.drone.emergency_amount_battery> self.drone.current_battery():
             return False
         return True
    
@@ -650,9 +1797,11 @@ class Delivery:
         if self.battery_required(packages) + self.drone.emergency_amount_battery > self.drone.max_battery:
             return False
         return True
-    def increment_drain(self, curr_location, location_to_go, curr_load, drain_rate, bcr_rate,height_rate):
+    def increment_drain(self, curr_location, location_to_go, curr_load, drain_rate, bcr_rate,height_rate,env=None):
         
         """Returns the amount of battery consumed by delivering a given list of packages"""
+        if env is None:
+            env = self.env_at(0)
         
         drain = 0
                 
@@ -668,9 +1817,9 @@ class Delivery:
                 
                 direction_vector = Coordinate(DV_x/DV_mag, DV_y/DV_mag)
 
-            DP = Coordinate.dot_product(direction_vector, self.env.vec)
+            DP = Coordinate.dot_product(direction_vector, env.vec)
            
-            wind_factor = math.exp(self.env.ws * self.env.factor * DP * -1)
+            wind_factor = math.exp(env.ws * env.factor * DP * -1)
         else:
             #ELSE NO EFFECT
             wind_factor = 1
@@ -686,9 +1835,10 @@ class Delivery:
         
         return self.drone.drain_rate * (1+total_weight*self.drone.bcr_rate) * distance
     
-    def deliver_package(self, package, increment,debug=False):
+    def deliver_package(self, package, increment,debug=False,start_time=0):
         """Delivers a package by starting at the current location and dropping it off at the next delivery location
-        while providing updates at certain intervals"""
+        while providing updates at certain intervals
+        The leg flies in the wind in effect at start_time, when it leaves, like the plan prices it"""
         if not debug:
             print(f'Delivering package {package.ID}')
         time_elapsed = 0
@@ -697,7 +1847,7 @@ class Delivery:
         time_drain = self.time_drain(curr_loc,nxt_loc)
         
         current_height = curr_loc.z
-        height_to_achieve = max(curr_loc.z,nxt_loc.z) + self.drone.altitude
+        height_to_achieve = self.cruise_height(curr_loc, nxt_loc)
         height_diff = height_to_achieve - self.drone.current_height()
         height_inc = height_diff/increment
                 
@@ -738,7 +1888,7 @@ class Delivery:
             new_coordinate = Coordinate(new_x, new_y,current_height)
             distance_covered = Coordinate.distance(curr_loc, new_coordinate)
             time_elapsed += distance_covered/self.drone.speed
-            curr_battery -= self.increment_drain(curr_loc,new_coordinate,self.drone.current_load(),self.drone.drain_rate,self.drone.bcr_rate,self.drone.height_rate)
+            curr_battery -= self.increment_drain(curr_loc,new_coordinate,self.drone.current_load(),self.drone.drain_rate,self.drone.bcr_rate,self.drone.height_rate,self.env_at(start_time))
             curr_loc = new_coordinate
             self.drone.update_location(curr_loc)
             self.drone.update_battery(curr_battery)
@@ -777,8 +1927,143 @@ class Delivery:
         
         return time_elapsed
     
-    def return_to_base(self,increment,debug=False):
-        """Returns to base"""
+    def state_fly(self, state, location):
+        """Returns the state after flying from the state's position to a location, carrying the state's load"""
+        curr = state.location()
+        drone = self.drone
+        drain = self.battery_drain(curr, location, state.load, drone.drain_rate, drone.bcr_rate, drone.height_rate,
+                                   self.env_at(state.time))
+        return state._replace(battery=state.battery - drain, x=location.x, y=location.y, z=location.z,
+                              time=state.time + self.time_drain(curr, location), coordinate=location)
+
+    def state_charge(self, state, time):
+        """Returns the state after charging for a given time, capped at the maximum battery"""
+        battery = min(state.battery + self.drone.charge_rate * time, self.drone.max_battery)
+        return state._replace(battery=battery, time=state.time + time)
+
+    def state_load(self, state, packages):
+        """Returns the state after loading packages"""
+        load = state.load + Delivery.weight_sum(packages)
+        if load>self.drone.capacity:
+            raise Exception("Package too heavy")
+        return state._replace(load=load)
+
+    def state_drop(self, state, package):
+        """Returns the state after dropping off a package"""
+        return state._replace(load=state.load - package.weight)
+
+    def simulate_state(self, path, state=None, charge_plan=None):
+        """Simulates a path from a DroneState without touching the drone and returns every state it goes through
+        Charging follows charge_plan if given, topping up like deliver() otherwise"""
+        if state is None:
+            state = self.drone.snapshot()
+        states = [state]
+        for i, pool in enumerate(path):
+            if charge_plan is not None and charge_plan[i]>0:
+                state = self.state_charge(state, charge_plan[i])
+                states.append(state)
+            charge = self.top_up(pool, state.battery, state.time)[0]
+            if charge>0:
+                state = self.state_charge(state, charge)
+                states.append(state)
+            state = self.state_load(state, pool)
+            for package in pool:
+                state = self.state_drop(self.state_fly(state, package.location), package)
+                states.append(state)
+            state = self.state_fly(state, self.base)
+            states.append(state)
+        return states
+
+    def what_if(self, paths, state=None, executor=None):
+        """Returns the final DroneState of every path simulated from the same state, optionally in an executor"""
+        if state is None:
+            state = self.drone.snapshot()
+        if executor is None:
+            return [self.simulate_state(path, state)[-1] for path in paths]
+        return list(executor.map(self.final_state, paths, [state]*len(paths)))
+
+    def final_state(self, path, state):
+        return self.simulate_state(path, state)[-1]
+
+    def leg_trajectory(self, curr_loc, nxt_loc, increment, start_battery=None, start_time=0, load=None):
+        """Returns the climb, cruise and landing of one leg as NumPy arrays t, x, y, z, battery (3*increment+1 samples)
+        in one vectorized pass, step for step the same values deliver_package() and return_to_base() go through"""
+        if np is None:
+            raise ImportError('numpy is required for trajectories')
+        if start_battery is None:
+            start_battery = self.drone.current_battery()
+        if load is None:
+            load = self.drone.current_load()
+        drone = self.drone
+        height_to_achieve = self.cruise_height(curr_loc, nxt_loc)
+        steps = np.ones(increment)
+        load_factor = 1 + load * drone.bcr_rate*(1/self.HEIGHT_CONSTANT)
+
+        #TAKING OFF
+        climb_inc = (height_to_achieve - curr_loc.z)/increment
+        climb_z = np.add.accumulate(np.concatenate(([curr_loc.z], climb_inc*steps)))
+        climb_drain = np.abs(climb_z[:-1] - climb_z[1:]) * load_factor * drone.drain_rate * drone.height_rate
+        climb_time = climb_inc/drone.takeoff_rate * steps
+
+        #MOVING TO LOCATION
+        x = np.add.accumulate(np.concatenate(([curr_loc.x], (nxt_loc.x - curr_loc.x)/increment*steps)))
+        y = np.add.accumulate(np.concatenate(([curr_loc.y], (nxt_loc.y - curr_loc.y)/increment*steps)))
+        DV_x = x[1:] - x[:-1]
+        DV_y = y[1:] - y[:-1]
+        distance = (DV_x**2 + DV_y**2)**0.5
+        if self.setenv==True:
+            env = self.env_at(start_time)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                direction_x = np.where(DV_x==0, 0, DV_x/distance)
+                direction_y = np.where(DV_x==0, 1, DV_y/distance)
+            wind_factor = np.exp(env.ws * env.factor * (direction_x*env.vec.x + direction_y*env.vec.y) * -1)
+        else:
+            wind_factor = 1
+        cruise_drain = drone.drain_rate * (1+(1/self.BCR_CONSTANT)*load*drone.bcr_rate) * wind_factor * distance
+        cruise_time = distance/drone.speed
+
+        #LANDING
+        land_inc = abs(nxt_loc.z - climb_z[-1])/increment
+        land_z = np.add.accumulate(np.concatenate(([climb_z[-1]], -land_inc*steps)))
+        land_drain = np.abs(land_z[:-1] - land_z[1:]) * load_factor * drone.drain_rate * drone.height_rate
+        land_time = land_inc/drone.takeoff_rate * steps
+
+        battery = np.subtract.accumulate(np.concatenate(([start_battery], climb_drain, cruise_drain, land_drain)))
+        t = start_time + np.add.accumulate(np.concatenate(([0], climb_time, cruise_time, land_time)))
+        return {'t': t,
+                'x': np.concatenate((np.full(increment+1, curr_loc.x), x[1:], np.full(increment, x[-1]))),
+                'y': np.concatenate((np.full(increment+1, curr_loc.y), y[1:], np.full(increment, y[-1]))),
+                'z': np.concatenate((climb_z, np.full(increment, climb_z[-1]), land_z[1:])),
+                'battery': battery}
+
+    def plan_trajectory(self, increment):
+        """Returns the whole best_path as one time series of NumPy arrays t, x, y, z, battery, charging like deliver()
+        without moving or draining the drone"""
+        if np is None:
+            raise ImportError('numpy is required for trajectories')
+        location = self.drone.current_location()
+        battery = self.drone.current_battery()
+        total_time = 0
+        pieces = []
+        for i, pool in enumerate(self.best_path):
+            if self.charge_plan is not None and self.charge_plan[i]>0:
+                total_time += self.charge_plan[i]
+                battery += self.drone.charge_rate * self.charge_plan[i]
+            charge_time, battery = self.top_up(pool, battery, total_time)
+            total_time += charge_time
+            for nxt in [package.location for package in pool] + [self.base]:
+                leg = self.leg_trajectory(location, nxt, increment, battery, total_time)
+                pieces.append(leg if len(pieces)==0 else {key: values[1:] for key, values in leg.items()})
+                location = Coordinate(leg['x'][-1], leg['y'][-1], leg['z'][-1])
+                battery = leg['battery'][-1]
+                total_time = leg['t'][-1]
+        if len(pieces)==0:
+            return {key: np.array([value]) for key, value in
+                    zip(['t', 'x', 'y', 'z', 'battery'], [0, location.x, location.y, location.z, battery])}
+        return {key: np.concatenate([piece[key] for piece in pieces]) for key in pieces[0]}
+
+    def return_to_base(self,increment,debug=False,start_time=0):
+        """Returns to base, flying in the wind in effect at start_time"""
         if not debug:
             print("RETURNING TO BASE")
         time_elapsed = 0
@@ -787,7 +2072,7 @@ class Delivery:
         nxt_loc = self.base
         time_drain = self.time_drain(curr_loc,nxt_loc)
         current_height = curr_loc.z
-        height_to_achieve = max(curr_loc.z,nxt_loc.z) + self.drone.altitude
+        height_to_achieve = self.cruise_height(curr_loc, nxt_loc)
         height_diff = abs(height_to_achieve - current_height)
         height_inc = height_diff/increment
                 
@@ -832,7 +2117,7 @@ class Delivery:
             distance_covered = Coordinate.distance(curr_loc, new_coordinate)
             time_elapsed += distance_covered/self.drone.speed
        
-            curr_battery -= self.increment_drain(curr_loc,new_coordinate,self.drone.current_load(),self.drone.drain_rate,self.drone.bcr_rate,self.drone.height_rate)
+            curr_battery -= self.increment_drain(curr_loc,new_coordinate,self.drone.current_load(),self.drone.drain_rate,self.drone.bcr_rate,self.drone.height_rate,self.env_at(start_time))
             curr_loc = new_coordinate
             self.drone.update_location(curr_loc)
             self.drone.update_battery(curr_battery)
@@ -869,10 +2154,27 @@ class Delivery:
         return time_elapsed
 
     
-    def charge_time(self, packages,curr_battery):
+    def top_up(self, packages, curr_battery, start_time=0):
+        """Returns the time the drone charges before leaving with a list of packages, topping up greedily to what they
+        need when it leaves, and the battery it leaves with; charging never goes above the maximum battery
+        Under a WindForecast charging moves the departure, so the packages may fall in another bucket and need more"""
+        EMERGENCY_AMOUNT = self.drone.emergency_amount_battery
+        mx_battery = self.drone.max_battery
+        time_elapsed = 0
+        battery_required = self.battery_required(packages,start_time=start_time)
+        while battery_required + EMERGENCY_AMOUNT>curr_battery and curr_battery<mx_battery:
+            target = min(battery_required + EMERGENCY_AMOUNT, mx_battery)
+            time_elapsed += (target-curr_battery)/self.drone.charge_rate
+            curr_battery = target
+            if not self.is_time_dependent():
+                break
+            battery_required = self.battery_required(packages,start_time=start_time+time_elapsed)
+        return time_elapsed, curr_battery
+
+    def charge_time(self, packages,curr_battery,start_time=0):
         """Returns the time taken to charge the drone enough to delivery a given list of packages"""
         EMERGENCY_AMOUNT = self.drone.emergency_amount_battery
-        battery_required = self.battery_required(packages)
+        battery_required = self.battery_required(packages,start_time=start_time)
         charge_time = (battery_required-curr_battery + EMERGENCY_AMOUNT)/self.drone.charge_rate
         return charge_time
 
@@ -909,6 +2211,11 @@ class Delivery:
             
     def min_battery_path(self, packages):
         """Returns the path that consumes the least amount of battery"""
+        #UNDER A FORECAST THE INDEX ORDERS TRIPS BY A LOWER BOUND, NOT BY THEIR BATTERY
+        for trip_index in ([] if self.is_time_dependent() else self.trip_indexes.values()):
+            mask = trip_index.mask_of(packages)
+            if mask is not None and mask in trip_index.trips:
+                return trip_index.trips[mask][0].copy()
         permuted_list = list(permutations(packages))
         for i in range(len(permuted_list)):
             permuted_list[i] = list(permuted_list[i])
@@ -916,25 +2223,163 @@ class Delivery:
         k = self.min_battery_index(permuted_list)
         return permuted_list[k]
     
+    def is_time_dependent(self):
+        """Checks whether leg costs depend on the departure time (wind forecast instead of a fixed environment)"""
+        return isinstance(self.env, WindForecast)
+
+    def env_at(self, time):
+        """Returns the environment in effect at a given time"""
+        if self.is_time_dependent():
+            return self.env.at(time)
+        return self.env
+
+    def env_buckets(self):
+        """Returns the environments leg costs are tabulated for, one per forecast bucket"""
+        if self.is_time_dependent():
+            return self.env.envs
+        return [self.env]
+
+    def drone_fingerprint(self):
+        """Returns the drone and model parameters leg costs depend on, the terrain included"""
+        drone = self.drone
+        fingerprint = (drone.drain_rate, drone.bcr_rate, drone.height_rate, drone.altitude, drone.speed, drone.takeoff_rate,
+                       self.HEIGHT_CONSTANT, self.BCR_CONSTANT)
+        if self.terrain is not None:
+            fingerprint += (self.terrain.fingerprint,)
+        return fingerprint
+
+    def env_fingerprint(self, env):
+        """Returns the environment parameters leg costs depend on"""
+        if not self.setenv:
+            return ('calm',)
+        return (env.ws, env.wd, env.factor)
+
+    def package_fingerprint(package):
+        """Returns what planning needs to know about a package, its identity and quantity aside"""
+        location = package.location
+        return (location.x, location.y, location.z, package.weight, package.priority)
+
+    def problem_fingerprint(self, packages):
+        """Returns a hex digest of everything a plan depends on: drone, environment, base, planner settings (the charge
+        levels and wind ensemble included) and the multiset of package fingerprints, so the same batch in any order
+        gets the same key"""
+        drone = self.drone
+        envs = self.env_buckets()
+        times = self.env.times if self.is_time_dependent() else [0]
+        problem = (self.drone_fingerprint(),
+                   (drone.capacity, drone.max_battery, drone.emergency_amount_battery, drone.charge_rate),
+                   self.setenv, [(time, self.env_fingerprint(env)) for time, env in zip(times, envs)],
+                   (self.base.x, self.base.y, self.base.z), sorted(self.priority_dict.items(), key=repr),
+                   (self.planner, self.time_budget, self.optimize_charging, self.CHARGE_LEVELS, self.breach_tolerance,
+                    None if self.wind_ensemble is None else self.wind_ensemble.fingerprint),
+                   sorted((Delivery.package_fingerprint(package) for package in packages), key=repr))
+        return hashlib.blake2b(repr(problem).encode(), digest_size=16).hexdigest()
+
+    def encode_plan(self, path):
+        """Returns a path as pools of package fingerprints, valid for any batch with the same fingerprint"""
+        return [[list(Delivery.package_fingerprint(package)) for package in pool] for pool in path]
+
+    def decode_plan(self, plan, packages):
+        """Maps an encoded plan back onto packages; identical packages are interchangeable"""
+        by_fingerprint = dict()
+        for package in packages:
+            by_fingerprint.setdefault(Delivery.package_fingerprint(package), []).append(package)
+        for same in by_fingerprint.values():
+            same.reverse()
+        return [[by_fingerprint[tuple(fingerprint)].pop() for fingerprint in pool] for pool in plan]
+
+    def build_leg_tables(self, packages):
+        """Precomputes the battery and time of every leg between the base and the package locations,
+        once per forecast bucket"""
+        if self.fleet_tables is not None:
+            return self.fleet_tables.leg_table(self, packages)
+        return LegTable(self, [self.base] + [package.location for package in packages])
+
+    def get_leg_table(self):
+        """Returns the leg table of the remaining packages, building it on first use"""
+        if self.leg_table is None:
+            self.leg_table = self.build_leg_tables(self.remaining_packages)
+        return self.leg_table
+
     def filter_packages(self):
-        """Filters out the packages that cross the drone's weight limit"""
-        i = 0
-        while i < len(self.remaining_packages):
-            if not self.has_enough_max_battery([self.remaining_packages[i]]) :
-                print(f'Package {self.remaining_packages[i].ID} delivery not possible due to battery constraint of drone')
-                        
-                self.remaining_packages.remove(self.remaining_packages[i])
-                continue
-            elif self.remaining_packages[i].weight>self.drone.capacity:
-                print(f'Package {self.remaining_packages[i].ID} is too heavy')
-                self.remaining_packages.remove(self.remaining_packages[i])
-                continue
-            elif self.time_drain(self.base,self.remaining_packages[i].location) > self.priority_dict[self.remaining_packages[i].priority]:
-                print(f'Package {self.remaining_packages[i].ID} not possible in {self.remaining_packages[i].priority} mode')
-                self.remaining_packages.remove(self.remaining_packages[i])
-                continue
-            else:
-                i += 1
+        """Filters out the packages the drone cannot deliver even on their own
+        remaining_packages becomes a new list, the caller's list is left as it is"""
+        accepted, rejected, reasons = self.feasibility_filter(self.packages)
+        self.remaining_packages = [self.packages[i] for i in accepted]
+        self.rejected_packages = [[self.packages[i], int(reason)] for i, reason in zip(rejected, reasons)]
+
+    def feasibility_filter(self, packages):
+        """Checks every package on its own trip, in one pass over arrays if numpy is installed
+        Returns the indexes of the accepted packages, of the rejected ones and the reason code of every rejection:
+        FILTER_BATTERY if the round trip needs more than the maximum battery, FILTER_WEIGHT if the package is
+        heavier than the capacity, FILTER_DEADLINE if the drone cannot reach it before its priority deadline"""
+        if np is None:
+            reasons = []
+            for package in packages:
+                if not self.has_enough_max_battery([package]):
+                    reasons.append(Delivery.FILTER_BATTERY)
+                elif package.weight>self.drone.capacity:
+                    reasons.append(Delivery.FILTER_WEIGHT)
+                elif self.time_drain(self.base, package.location)>self.priority_dict[package.priority]:
+                    reasons.append(Delivery.FILTER_DEADLINE)
+                else:
+                    reasons.append(0)
+            return ([i for i, reason in enumerate(reasons) if reason==0], [i for i, reason in enumerate(reasons) if reason!=0],
+                    [reason for reason in reasons if reason!=0])
+        weights = np.array([package.weight for package in packages], dtype=float)
+        battery, arrival = self.round_trips(packages)
+        reasons = np.zeros(len(packages), dtype=np.int64)
+        reasons[weights>self.drone.capacity] = Delivery.FILTER_WEIGHT
+        reasons[battery + self.drone.emergency_amount_battery>self.drone.max_battery] = Delivery.FILTER_BATTERY
+        #ONLY PACKAGES PASSING THE OTHER CHECKS NEED A KNOWN PRIORITY
+        candidates = np.flatnonzero(reasons==0)
+        deadlines = np.array([self.priority_dict[packages[i].priority] for i in candidates], dtype=float)
+        reasons[candidates[arrival[candidates]>deadlines]] = Delivery.FILTER_DEADLINE
+        rejected = np.flatnonzero(reasons)
+        return np.flatnonzero(reasons==0), rejected, reasons[rejected]
+
+    def round_trips(self, packages):
+        """Returns the battery of the base -> package -> base trip and the arrival time at every package, as arrays
+        The legs follow battery_drain and time_drain term by term, the return leg in the forecast bucket it leaves in"""
+        drone = self.drone
+        x = np.array([package.location.x for package in packages], dtype=float)
+        y = np.array([package.location.y for package in packages], dtype=float)
+        z = np.array([package.location.z for package in packages], dtype=float)
+        weights = np.array([package.weight for package in packages], dtype=float)
+        base = self.base
+        height_to_achieve = np.maximum(base.z, z)
+        if self.terrain is not None:
+            height_to_achieve = np.maximum(height_to_achieve, self.terrain.highest(base.x, base.y, x, y))
+        height_to_achieve = height_to_achieve + drone.altitude
+        distance = ((x - base.x)**2 + (y - base.y)**2)**0.5
+        arrival = np.abs(height_to_achieve - base.z) / drone.takeoff_rate + distance / drone.speed + np.abs(height_to_achieve - z) / drone.takeoff_rate
+
+        def wind_factors(dx, dy, buckets):
+            if not self.setenv:
+                return np.ones(len(packages))
+            envs = self.env_buckets()
+            moving = dx!=0
+            ux = np.divide(dx, distance, out=np.zeros_like(dx), where=moving)
+            uy = np.divide(dy, distance, out=np.ones_like(dy), where=moving)
+            ws = np.array([env.ws for env in envs])[buckets]
+            dot_product = ux*np.array([env.vec.x for env in envs])[buckets] + uy*np.array([env.vec.y for env in envs])[buckets]
+            return np.exp(ws * np.array([env.factor for env in envs])[buckets] * dot_product * -1)
+
+        def leg(curr_z, nxt_z, load, wind_factor):
+            height_rate = (1+load*(1/self.HEIGHT_CONSTANT)*drone.bcr_rate)*drone.drain_rate*drone.height_rate
+            drain = np.abs(height_to_achieve - curr_z) * height_rate
+            drain += drone.drain_rate * (1+load*drone.bcr_rate*(1/self.BCR_CONSTANT)) * wind_factor * distance
+            drain += np.abs(height_to_achieve - nxt_z) * height_rate
+            return drain
+
+        outbound_buckets = np.zeros(len(packages), dtype=np.int64)
+        return_buckets = outbound_buckets
+        if self.is_time_dependent():
+            outbound_buckets[:] = self.env.bucket(0)
+            return_buckets = np.maximum(np.searchsorted(self.env.times, arrival, side='right') - 1, 0)
+        battery = leg(base.z, z, weights, wind_factors(x - base.x, y - base.y, outbound_buckets))
+        battery += leg(z, base.z, 0, wind_factors(base.x - x, base.y - y, return_buckets))
+        return battery, arrival
 
 ##    def deliver(self,debug=False):
 ##        """Delivers all the packages using the optimal route
@@ -1025,21 +2470,25 @@ class Delivery:
         for i in range(len(path_to_follow)):
             pool = path_to_follow[i]
 
-            if not self.has_enough_battery(pool):
-                time_to_charge = self.charge_time(pool,self.drone.current_battery())
+            if self.charge_plan is not None and self.charge_plan[i]>0:
+                print(f'CHARGING FOR {self.charge_plan[i]} minutes')
+                total_time += self.drone.charge(self.charge_plan[i])
+                print(f'AFTER CHARGE: {self.drone.current_battery()}')
+            time_to_charge = self.top_up(pool,self.drone.current_battery(),start_time=total_time)[0]
+            if time_to_charge>0:
                 print(f'CHARGING FOR {time_to_charge} minutes')
                 total_time += self.drone.charge(time_to_charge)
                 print(f'AFTER CHARGE: {self.drone.current_battery()}')
             print(f'Pool to deliver: {pool}')
             for package in pool:
-                total_time += self.deliver_package(package, INCREMENT,debug)
+                total_time += self.deliver_package(package, INCREMENT,debug,start_time=total_time)
                 print(f' Current Battery: {self.drone.battery}')
                 to_return_time_list.append(total_time)
                 to_return_package_list.append(package)
                 to_return_path_list.append([package,package.location])
                 to_return_battery_list.append(self.drone.battery)
             
-            base_return_time = self.return_to_base(INCREMENT,debug)
+            base_return_time = self.return_to_base(INCREMENT,debug,start_time=total_time)
             print(f'RETURN TIME: {base_return_time}')
             total_time += base_return_time
             to_return_time_list.append(total_time)
@@ -1059,6 +2508,29 @@ class Delivery:
         total_return_list.append(to_return_path_list)
         total_return_list.append(to_return_battery_list)
         return total_return_list     
+
+    async def deliver_stream(self, increment=1, delay=0):
+        """Simulates deliver() as an async telemetry stream, yielding an event dictionary after every charge,
+        drop-off and return to base, and sleeping delay seconds between events so the event loop keeps running"""
+        total_time = 0
+        for i, pool in enumerate(self.best_path.copy()):
+            if self.charge_plan is not None and self.charge_plan[i]>0:
+                total_time += self.drone.charge(self.charge_plan[i])
+                yield {'event': 'charge', 'time': total_time, 'location': self.base, 'battery': self.drone.battery}
+                await asyncio.sleep(delay)
+            time_to_charge = self.top_up(pool,self.drone.current_battery(),start_time=total_time)[0]
+            if time_to_charge>0:
+                total_time += self.drone.charge(time_to_charge)
+                yield {'event': 'charge', 'time': total_time, 'location': self.base, 'battery': self.drone.battery}
+                await asyncio.sleep(delay)
+            for package in pool:
+                total_time += self.deliver_package(package, increment, True, start_time=total_time)
+                yield {'event': 'delivered', 'package': package, 'time': total_time,
+                       'location': package.location, 'battery': self.drone.battery}
+                await asyncio.sleep(delay)
+            total_time += self.return_to_base(increment, True, start_time=total_time)
+            yield {'event': 'base', 'time': total_time, 'location': self.base, 'battery': self.drone.battery}
+            await asyncio.sleep(delay)
 ##     
 ##            
 ##        while len(self.remaining_packages) > 0:
@@ -1113,6 +2585,619 @@ class Delivery:
 
         
     
+class PlanUpdate:
+    """
+    PlanUpdate class representing an incumbent reported by the anytime planner, or the result of Delivery.plan()
+    Attributes:
+    - path (List[List[Package]]): best path found so far
+    - battery (float): total battery of the path
+    - bound (float): lower bound on the battery of any plan
+    - gap (float): relative optimality gap (battery - bound) / battery
+    - elapsed (float): seconds since planning started
+    - optimal (bool): whether the search finished, proving the path optimal
+    """
+
+    def __init__(self, path, battery, bound, elapsed, optimal):
+        self.path = path
+        self.battery = battery
+        self.bound = bound
+        self.gap = (battery - bound)/battery if battery>0 else 0
+        self.elapsed = elapsed
+        self.optimal = optimal
+
+    def __repr__(self):
+        return f'PlanUpdate(battery={self.battery}, gap={self.gap}, elapsed={self.elapsed}, optimal={self.optimal})'
+
+
+class ParetoArchive:
+    """
+    ParetoArchive class keeping the non-dominated paths found during a search
+    Entries are kept sorted by their first objective, so a new point is only compared with entries
+    that could dominate it (lower first objective) or that it could dominate (higher first objective)
+    Attributes:
+    - objectives (List[Tuple]): objective vector of every entry, all objectives minimized
+    - paths (List): path of every entry
+    """
+
+    def __init__(self):
+        self.objectives = []
+        self.paths = []
+
+    def __len__(self):
+        return len(self.objectives)
+
+    def dominates(first, second):
+        """Checks whether first is no worse than second in every objective"""
+        for a, b in zip(first, second):
+            if a>b:
+                return False
+        return True
+
+    def add(self, objectives, path):
+        """Adds a path unless an archived one dominates it, dropping the archived paths it dominates
+        Returns whether the path was added"""
+        objectives = tuple(objectives)
+        firsts = [entry[0] for entry in self.objectives]
+        upper = bisect.bisect_right(firsts, objectives[0])
+        for i in range(upper):
+            if ParetoArchive.dominates(self.objectives[i], objectives):
+                return False
+        lower = bisect.bisect_left(firsts, objectives[0])
+        i = lower
+        while i<len(self.objectives):
+            if ParetoArchive.dominates(objectives, self.objectives[i]):
+                del self.objectives[i]
+                del self.paths[i]
+            else:
+                i += 1
+        self.objectives.insert(lower, objectives)
+        self.paths.insert(lower, path)
+        return True
+
+    def best(self, weights):
+        """Returns the [objectives, path] entry minimizing a weighted sum of the objectives, e.g. one dispatch policy"""
+        if len(self.objectives)==0:
+            return None
+        i = min(range(len(self.objectives)), key=lambda i: sum(w*o for w, o in zip(weights, self.objectives[i])))
+        return [self.objectives[i], self.paths[i]]
+
+    def entries(self):
+        """Returns the archive as a list of [objectives, path], by increasing first objective"""
+        return [[objectives, path] for objectives, path in zip(self.objectives, self.paths)]
+
+
+class TripIndex:
+    """
+    TripIndex class holding every feasible trip (pool) of a batch, computed once with a subset DP
+    The cost of finishing a trip depends only on where the drone is and which packages are still on board
+    (the load is their weight), so the best order of a pool extends the best orders of its sub-pools
+    With a WindForecast the cost of a trip depends on when it leaves, so every leg is priced at its cheapest
+    forecast bucket: the trips then hold lower bounds, and a trip is kept if it fits the battery in any bucket
+    The DP stops once time.monotonic() passes deadline, leaving the index incomplete
+    Attributes:
+    - packages (List[Package]): packages of the batch, package i is bit i of a mask
+    - trips (dict): pool bitmask -> [best order (List[Package]), battery (a lower bound under a forecast), duration]
+    - complete (bool): False if the deadline passed first, trips then only holds some of the feasible trips
+    """
+
+    def __init__(self, delivery, packages, deadline=None):
+        self.packages = list(packages)
+        self.bit = {id(package): 1<<i for i, package in enumerate(self.packages)}
+        self.trips = dict()
+        self.complete = False
+        expired = lambda: deadline is not None and time.monotonic()>deadline
+        n = len(self.packages)
+        capacity = delivery.drone.capacity
+        weights = [package.weight for package in self.packages]
+        leg_table = delivery.build_leg_tables(self.packages)
+        timed = delivery.is_time_dependent()
+        #CHEAPEST BUCKET OF EVERY LEG; fixed AND per_load ARE BOTH LOWER BOUNDS AND THE LOAD IS NOT NEGATIVE
+        fixed = [[min(bucket[i][j] for bucket in leg_table.fixed) for j in range(n+1)] for i in range(n+1)]
+        per_load = [[min(bucket[i][j] for bucket in leg_table.per_load) for j in range(n+1)] for i in range(n+1)]
+
+        def drain(i, j, load):
+            #ROW 0 IS THE BASE, ROW i+1 IS PACKAGE i
+            return fixed[i][j] + per_load[i][j] * load
+
+        #EVERY POOL WITHIN CAPACITY, A SUB-POOL ALWAYS HAS A SMALLER MASK
+        load_of = {0: 0}
+        stack = [(0, 0)]
+        while stack:
+            if expired():
+                return
+            mask, start = stack.pop()
+            for i in range(start, n):
+                load = load_of[mask] + weights[i]
+                if load<=capacity:
+                    load_of[mask | (1<<i)] = load
+                    stack.append((mask | (1<<i), i+1))
+        masks = sorted(load_of)
+
+        #finish[(j, mask)]: best battery from package j with mask still on board, and the next package
+        finish = dict()
+        for mask in masks:
+            if expired():
+                return
+            for j in range(n):
+                if mask & (1<<j):
+                    continue
+                if mask==0:
+                    finish[(j, 0)] = (drain(j+1, 0, 0), None)
+                    continue
+                best = None
+                for k in range(n):
+                    if mask & (1<<k):
+                        cost = drain(j+1, k+1, load_of[mask]) + finish[(k, mask ^ (1<<k))][0]
+                        if best is None or cost<best[0]:
+                            best = (cost, k)
+                finish[(j, mask)] = best
+
+        for mask in masks[1:]:
+            if expired():
+                return
+            best = None
+            for j in range(n):
+                if mask & (1<<j):
+                    cost = drain(0, j+1, load_of[mask]) + finish[(j, mask ^ (1<<j))][0]
+                    if best is None or cost<best[0]:
+                        best = (cost, j)
+            order = []
+            j, remaining = best[1], mask
+            while j is not None:
+                order.append(self.packages[j])
+                remaining ^= 1<<j
+                j = finish[(j, remaining)][1]
+            battery = best[0] if timed else delivery.battery_required(order)
+            if battery + delivery.drone.emergency_amount_battery > delivery.drone.max_battery:
+                continue
+            self.trips[mask] = [order, battery, delivery.pool_timings(order)[1]]
+        self.complete = True
+
+    def mask_of(self, pool):
+        """Returns the bitmask of a pool, or None if a package is not part of the batch"""
+        mask = 0
+        for package in pool:
+            if id(package) not in self.bit:
+                return None
+            mask |= self.bit[id(package)]
+        return mask
+
+    def packages_of(self, mask):
+        """Returns the packages of a bitmask in batch order"""
+        return [package for i, package in enumerate(self.packages) if mask & (1<<i)]
+
+    def lookup(self, pool):
+        """Returns [best order, battery, duration] of a pool, or None if the pool is not a feasible trip"""
+        mask = self.mask_of(pool)
+        if mask is None:
+            return None
+        return self.trips.get(mask)
+
+
+class LegTable:
+    """
+    LegTable class holding precomputed leg costs between the base and the package locations
+    Battery drained on a leg is affine in the load, so every leg is stored as fixed + per_load * load
+    Attributes:
+    - locations (List[Coordinate]): base followed by every package location
+    - index (dict): maps id() of a location to its row in the table
+    - fixed (List[List[List[float]]]): battery drained on a leg with no load, per forecast bucket
+    - per_load (List[List[List[float]]]): extra battery drained per unit of load, per forecast bucket
+    - time (List[List[float]]): time taken to fly a leg
+    """
+
+    def __init__(self, delivery, locations):
+        drone = delivery.drone
+        cache = delivery.leg_cache
+        self.locations = locations
+        self.index = {id(location): i for i, location in enumerate(locations)}
+        self.fixed = []
+        self.per_load = []
+        self.time = [[0]*len(locations) for _ in locations]
+        for env in delivery.env_buckets():
+            fixed = [[0]*len(locations) for _ in locations]
+            per_load = [[0]*len(locations) for _ in locations]
+            if cache is not None:
+                prefix = repr((delivery.drone_fingerprint(), delivery.env_fingerprint(env))).encode()
+                location_keys = [struct.pack('<ddd', location.x, location.y, location.z) for location in locations]
+            for i, curr in enumerate(locations):
+                for j, nxt in enumerate(locations):
+                    if i==j or curr is nxt:
+                        #SAME LOCATION OBJECT, battery_drain AND time_drain ARE 0; THE CACHE KEY ONLY HOLDS COORDINATES,
+                        #SO THIS 0 MUST NOT BE STORED FOR TWO OBJECTS AT THE SAME SPOT
+                        continue
+                    if cache is not None:
+                        key = LegCostCache.key(prefix, location_keys[i], location_keys[j])
+                        cached = cache.get(key)
+                        if cached is not None:
+                            fixed[i][j], per_load[i][j], self.time[i][j] = cached
+                            continue
+                    empty = delivery.battery_drain(curr, nxt, 0, drone.drain_rate, drone.bcr_rate, drone.height_rate, env)
+                    loaded = delivery.battery_drain(curr, nxt, 1, drone.drain_rate, drone.bcr_rate, drone.height_rate, env)
+                    fixed[i][j] = empty
+                    per_load[i][j] = loaded - empty
+                    self.time[i][j] = delivery.time_drain(curr, nxt)
+                    if cache is not None:
+                        cache.put(key, fixed[i][j], per_load[i][j], self.time[i][j])
+            self.fixed.append(fixed)
+            self.per_load.append(per_load)
+
+    def from_costs(locations, fixed, per_load, time):
+        """Builds a table from costs computed elsewhere, laid out like the attributes"""
+        table = LegTable.__new__(LegTable)
+        table.locations = locations
+        table.index = {id(location): i for i, location in enumerate(locations)}
+        table.fixed = fixed
+        table.per_load = per_load
+        table.time = time
+        return table
+
+    def bucket(self, delivery, time):
+        """Returns the forecast bucket a leg leaving at a given time falls in"""
+        if delivery.is_time_dependent():
+            return delivery.env.bucket(time)
+        return 0
+
+    def drain(self, delivery, curr, nxt, load, time=0):
+        """Returns the battery drained on a leg leaving at a given time"""
+        i = self.index.get(id(curr))
+        j = self.index.get(id(nxt))
+        if i is None or j is None:
+            #LOCATION NOT TABULATED, FALL BACK TO THE DIRECT FORMULA
+            drone = delivery.drone
+            return delivery.battery_drain(curr, nxt, load, drone.drain_rate, drone.bcr_rate, drone.height_rate, delivery.env_at(time))
+        b = self.bucket(delivery, time)
+        return self.fixed[b][i][j] + self.per_load[b][i][j] * load
+
+    def leg_time(self, delivery, curr, nxt):
+        """Returns the time taken to fly a leg"""
+        i = self.index.get(id(curr))
+        j = self.index.get(id(nxt))
+        if i is None or j is None:
+            return delivery.time_drain(curr, nxt)
+        return self.time[i][j]
+
+
+class FleetCostTables:
+    """
+    FleetCostTables class holding leg cost tables of several drone models over the same packages
+    The geometry every model shares (distances, climbs to the higher end of a leg, wind factors) is computed once
+    in a batched NumPy pass; a model only scales it by its own rates, so adding one costs a few array operations
+    Row 0 is the base, row i+1 is package i
+    Attributes:
+    - packages (List[Package]): packages the tables cover
+    - index (dict): maps id() of a package location to its row
+    - distance (ndarray): horizontal distance of every leg
+    - terrain (TerrainGrid): elevation the legs cruise above, None for flat ground
+    - conditions (tuple): wind switch, forecast steps and model constants the tables were built for
+    - rise, fall (ndarray): climb from the start and descent to the end of every leg, up to the higher end or the
+      highest terrain along it
+    - wind (ndarray): wind factor of every leg, per forecast bucket
+    - same (ndarray): True where a leg starts and ends at the same location object, such legs cost nothing
+    - tables (dict): drone model -> fixed, per_load and time arrays laid out like LegTable
+    """
+
+    def __init__(self, packages, env, setenv=False, drones=(), height_constant=1000, bcr_constant=1000, terrain=None):
+        if np is None:
+            raise ImportError('numpy is required for fleet cost tables')
+        self.packages = list(packages)
+        self.HEIGHT_CONSTANT = height_constant
+        self.BCR_CONSTANT = bcr_constant
+        self.terrain = terrain
+        self.conditions = FleetCostTables.table_conditions(env, setenv, height_constant, bcr_constant)
+        locations = [Coordinate(0, 0, 0)] + [package.location for package in self.packages]
+        self.index = dict()
+        for i, location in enumerate(locations[1:]):
+            self.index.setdefault(id(location), i+1)
+        x = np.array([location.x for location in locations], dtype=float)
+        y = np.array([location.y for location in locations], dtype=float)
+        z = np.array([location.z for location in locations], dtype=float)
+        rows = np.array([0] + [self.index[id(location)] for location in locations[1:]])
+        self.same = rows[:, None]==rows[None, :]
+        dx = x[None, :] - x[:, None]
+        dy = y[None, :] - y[:, None]
+        self.distance = (dx**2 + dy**2)**0.5
+        top = np.maximum(z[:, None], z[None, :])
+        if terrain is not None:
+            #ONE ROW OF LEGS AT A TIME, SO THE SAMPLES OF ALL LEGS ARE NEVER HELD AT ONCE
+            for i in range(len(locations)):
+                top[i] = np.maximum(top[i], terrain.highest(x[i], y[i], x, y))
+        self.rise = top - z[:, None]
+        self.fall = top - z[None, :]
+        #SAME DIRECTION CONVENTION AS battery_drain: (0, 1) WHEN THE LEG HAS NO x COMPONENT
+        moving = dx!=0
+        ux = np.divide(dx, self.distance, out=np.zeros_like(dx), where=moving)
+        uy = np.divide(dy, self.distance, out=np.ones_like(dy), where=moving)
+        envs = env.envs if isinstance(env, WindForecast) else [env]
+        self.wind = np.ones((len(envs),) + self.distance.shape)
+        if setenv:
+            for b, bucket_env in enumerate(envs):
+                dot_product = ux*bucket_env.vec.x + uy*bucket_env.vec.y
+                self.wind[b] = np.exp(bucket_env.ws * bucket_env.factor * dot_product * -1)
+        self.tables = dict()
+        for drone in drones:
+            self.add(drone)
+
+    def table_conditions(env, setenv, height_constant, bcr_constant):
+        """Returns everything besides the drone model and the locations the tables depend on"""
+        envs = env.envs if isinstance(env, WindForecast) else [env]
+        times = env.times if isinstance(env, WindForecast) else [0]
+        return (setenv, tuple((time, bucket_env.ws, bucket_env.wd, bucket_env.factor) for time, bucket_env in zip(times, envs)),
+                height_constant, bcr_constant)
+
+    def model(drone):
+        """Returns the drone parameters leg costs depend on, drones sharing them share a table"""
+        return (drone.drain_rate, drone.bcr_rate, drone.height_rate, drone.altitude, drone.speed, drone.takeoff_rate)
+
+    def add(self, drone):
+        """Computes the tables of a drone's model from the shared geometry, if not done yet, and returns them"""
+        model = FleetCostTables.model(drone)
+        if model in self.tables:
+            return self.tables[model]
+        drain_rate, bcr_rate, height_rate, altitude, speed, takeoff_rate = model
+        vertical = np.abs(self.rise + altitude) + np.abs(self.fall + altitude)
+        cruise = drain_rate * self.wind * self.distance
+        climb = vertical * drain_rate * height_rate
+        fixed = climb + cruise
+        per_load = climb * bcr_rate / self.HEIGHT_CONSTANT + cruise * bcr_rate / self.BCR_CONSTANT
+        time = vertical / takeoff_rate + self.distance / speed
+        fixed[:, self.same] = 0
+        per_load[:, self.same] = 0
+        time[self.same] = 0
+        self.tables[model] = (fixed, per_load, time)
+        return self.tables[model]
+
+    def leg_table(self, delivery, packages):
+        """Returns a LegTable of the delivery's drone over its base and the given packages, cut from the fleet tables"""
+        if delivery.terrain is not self.terrain:
+            raise Exception('Fleet tables were built over another terrain')
+        if FleetCostTables.table_conditions(delivery.env, delivery.setenv, delivery.HEIGHT_CONSTANT, delivery.BCR_CONSTANT)!=self.conditions:
+            raise Exception('Fleet tables were built for another environment')
+        fixed, per_load, time = self.add(delivery.drone)
+        rows = np.array([0] + [self.index[id(package.location)] for package in packages])
+        cut = np.ix_(rows, rows)
+        return LegTable.from_costs([delivery.base] + [package.location for package in packages],
+                                   [bucket[cut].tolist() for bucket in fixed], [bucket[cut].tolist() for bucket in per_load],
+                                   time[cut].tolist())
+
+
+class SharedProblem:
+    """
+    SharedProblem class placing a compiled batch in one multiprocessing.shared_memory block
+    Worker processes attach to the block by name and read it through flat float64 views without copying
+    Package i is row i+1 of the leg matrices, row 0 is the base
+    Attributes:
+    - spec (dict): block name, batch size and drone limits, everything attach() needs
+    - weights, deadlines (memoryview): weight and priority deadline of every package
+    - coordinates (memoryview): x, y, z of the base and every package
+    - fixed, per_load (memoryview): leg battery as fixed + per_load * load, bucket-major (n+1) x (n+1) matrices
+    - time (memoryview): (n+1) x (n+1) leg flight times
+    """
+    FIELDS = ['weights', 'deadlines', 'coordinates', 'fixed', 'per_load', 'time']
+
+    def sizes(spec):
+        """Returns the number of float64 values of every field"""
+        n = spec['n']
+        rows = n + 1
+        return {'weights': n, 'deadlines': n, 'coordinates': 3*rows, 'fixed': spec['buckets']*rows*rows,
+                'per_load': spec['buckets']*rows*rows, 'time': rows*rows}
+
+    def __init__(self, spec, shm):
+        self.spec = spec
+        self.shm = shm
+        self.views = [shm.buf.cast('d')]
+        self.offsets = dict()
+        offset = 0
+        for field, size in SharedProblem.sizes(spec).items():
+            view = self.views[0][offset:offset+size]
+            self.views.append(view)
+            self.offsets[field] = offset
+            setattr(self, field, view)
+            offset += size
+
+    def create(delivery, packages):
+        """Compiles a batch into a new shared block; the caller closes and unlinks it when done"""
+        locations = [delivery.base] + [package.location for package in packages]
+        leg_table = delivery.build_leg_tables(packages)
+        spec = {'n': len(packages), 'buckets': len(leg_table.fixed), 'capacity': delivery.drone.capacity,
+                'max_battery': delivery.drone.max_battery, 'emergency': delivery.drone.emergency_amount_battery}
+        size = sum(SharedProblem.sizes(spec).values())
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1)*8)
+        spec['name'] = shm.name
+        problem = SharedProblem(spec, shm)
+        rows = len(locations)
+        for i, package in enumerate(packages):
+            problem.weights[i] = package.weight
+            problem.deadlines[i] = delivery.priority_dict[package.priority]
+        for i, location in enumerate(locations):
+            problem.coordinates[3*i:3*i+3] = memoryview(struct.pack('<ddd', location.x, location.y, location.z)).cast('d')
+            for j in range(rows):
+                problem.time[i*rows + j] = leg_table.time[i][j]
+                for b in range(spec['buckets']):
+                    problem.fixed[(b*rows + i)*rows + j] = leg_table.fixed[b][i][j]
+                    problem.per_load[(b*rows + i)*rows + j] = leg_table.per_load[b][i][j]
+        return problem
+
+    def attach(spec):
+        """Attaches to a block created in another process"""
+        return SharedProblem(spec, shared_memory.SharedMemory(name=spec['name']))
+
+    def array(self, field):
+        """Returns a NumPy view of a field sharing the block's memory"""
+        if np is None:
+            raise ImportError('numpy is required for array views')
+        return np.frombuffer(self.shm.buf, dtype=np.float64, count=SharedProblem.sizes(self.spec)[field],
+                             offset=8*self.offsets[field])
+
+    def pool_battery(self, pool, bucket=0):
+        """Returns the battery of a pool given as package positions"""
+        rows = self.spec['n'] + 1
+        base = bucket*rows
+        load = 0
+        for i in pool:
+            load += self.weights[i]
+        required = 0
+        curr = 0
+        for i in pool:
+            leg = (base + curr)*rows + i + 1
+            required += self.fixed[leg] + self.per_load[leg] * load
+            load -= self.weights[i]
+            curr = i + 1
+        leg = (base + curr)*rows
+        required += self.fixed[leg] + self.per_load[leg] * load
+        return required
+
+    def path_feasible(self, path):
+        """Checks the weight and battery limits of every pool of a path given as package positions"""
+        for pool in path:
+            weight = 0
+            for i in pool:
+                weight += self.weights[i]
+            if weight>self.spec['capacity']:
+                return False
+            if self.pool_battery(pool) + self.spec['emergency']>self.spec['max_battery']:
+                return False
+        return True
+
+    def close(self):
+        """Releases the views and detaches from the block"""
+        for view in self.views[::-1]:
+            view.release()
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the block, called once by its creator"""
+        self.shm.unlink()
+
+
+class LegCostCache:
+    """
+    LegCostCache class representing a persistent, memory-mapped cache of leg costs shared across runs
+    The file is a fixed-size open-addressing hash table, so opening it only maps it into memory, and a full
+    probe window evicts its least recently used record
+    Record layout: 16-byte key digest, u64 use stamp, fixed battery, battery per unit load, flight time
+    Attributes:
+    - path (str): location of the cache file
+    - slots (int): number of records the file can hold
+    """
+    MAGIC = b'LEGC'
+    HEADER = struct.Struct('<4sIQQ')
+    RECORD = struct.Struct('<16sQddd')
+    PROBES = 8
+
+    def __init__(self, path, slots=1<<16):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.write(LegCostCache.HEADER.pack(LegCostCache.MAGIC, 1, slots, 0))
+                file.truncate(LegCostCache.HEADER.size + slots * LegCostCache.RECORD.size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.slots, self.clock = LegCostCache.HEADER.unpack_from(self.map, 0)
+        if magic!=LegCostCache.MAGIC:
+            raise Exception(f'{path} is not a leg cost cache')
+
+    def key(prefix, first_location, second_location):
+        """Returns the 16-byte digest of a leg: prefix encodes the drone and env fingerprints, locations are packed x, y, z"""
+        return hashlib.blake2b(prefix + first_location + second_location, digest_size=16).digest()
+
+    def offset(self, slot):
+        return LegCostCache.HEADER.size + slot * LegCostCache.RECORD.size
+
+    def probe(self, key):
+        """Returns the slots a key may live in"""
+        home = int.from_bytes(key[:8], 'little') % self.slots
+        return [(home + i) % self.slots for i in range(min(LegCostCache.PROBES, self.slots))]
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, key):
+        """Returns (fixed, per_load, time) of a leg, or None if it is not cached"""
+        for slot in self.probe(key):
+            offset = self.offset(slot)
+            if self.map[offset:offset+16]==key:
+                struct.pack_into('<Q', self.map, offset + 16, self.tick())
+                return struct.unpack_from('<ddd', self.map, offset + 24)
+        return None
+
+    def put(self, key, fixed, per_load, time_taken):
+        """Stores a leg, replacing the least recently used record of its probe window if the window is full"""
+        victim = None
+        victim_stamp = None
+        for slot in self.probe(key):
+            record_key, stamp = struct.unpack_from('<16sQ', self.map, self.offset(slot))
+            if record_key==key or stamp==0:
+                victim = slot
+                break
+            if victim is None or stamp<victim_stamp:
+                victim, victim_stamp = slot, stamp
+        LegCostCache.RECORD.pack_into(self.map, self.offset(victim), key, self.tick(), fixed, per_load, time_taken)
+
+    def flush(self):
+        """Writes the use clock and the mapped records back to disk"""
+        LegCostCache.HEADER.pack_into(self.map, 0, LegCostCache.MAGIC, 1, self.slots, self.clock)
+        self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+
+class PlanCache:
+    """
+    PlanCache class holding plans of batches seen before, keyed by Delivery.problem_fingerprint()
+    Plans live in an in-memory LRU tier and, if a directory is given, in one JSON file per key that outlives the process
+    Attributes:
+    - capacity (int): plans the memory tier holds before evicting the least recently used one
+    - directory (str): folder of the disk tier, None for memory only
+    - plans (OrderedDict): key -> encoded plan, least recently used first
+    """
+
+    def __init__(self, capacity=256, directory=None):
+        self.capacity = capacity
+        self.directory = directory
+        self.plans = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self.plans)
+
+    def file(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the encoded plan of a key, reading the disk tier on a memory miss, or None if it was never stored"""
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.plans.move_to_end(key)
+            return plan
+        if self.directory is None or not os.path.exists(self.file(key)):
+            return None
+        with open(self.file(key)) as file:
+            plan = json.load(file)
+        self.remember(key, plan)
+        return plan
+
+    def put(self, key, plan):
+        """Stores an encoded plan in memory and, if enabled, on disk"""
+        self.remember(key, plan)
+        if self.directory is not None:
+            temporary = self.file(key) + '.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(plan, file)
+            os.replace(temporary, self.file(key))
+
+    def remember(self, key, plan):
+        self.plans[key] = plan
+        self.plans.move_to_end(key)
+        while len(self.plans)>self.capacity:
+            self.plans.popitem(last=False)
+
+
 class Environment:
     #ENVIRONMENT CLASS
     def __init__(self, ws, wd,factor=0.1):
@@ -1123,9 +3208,252 @@ class Environment:
     def vector(self):
         direction = math.radians(self.wd)
         return [math.cos(direction), math.sin(direction)]
-        
-    
-    
+
+
+class WindForecast:
+    """
+    WindForecast class representing a time-indexed environment built from tabulated forecast steps
+    Attributes:
+    - times (List[float]): start time of every forecast step, each step lasts until the next one starts
+    - envs (List[Environment]): environment in effect during every forecast step
+    - factor (float): wind effect factor shared by all steps
+    """
+
+    def __init__(self, steps, factor=0.1):
+        if len(steps)==0:
+            raise Exception('Forecast needs at least one step')
+        steps = sorted(steps, key=lambda step: step[0])
+        self.times = [step[0] for step in steps]
+        self.envs = [Environment(ws, wd, factor) for _, ws, wd in steps]
+        self.factor = factor
+
+    def bucket(self, time):
+        """Returns the index of the forecast step in effect at a given time"""
+        return max(bisect.bisect_right(self.times, time) - 1, 0)
+
+    def at(self, time):
+        """Returns the environment in effect at a given time"""
+        return self.envs[self.bucket(time)]
+
+
+class WindEnsemble:
+    """
+    WindEnsemble class representing Monte Carlo samples of the error between the nominal and the actual wind
+    Every sample shifts the wind speed and direction of the whole delivery; the seed is fixed so every
+    candidate path is scored against the same samples
+    Attributes:
+    - speed_errors (ndarray): wind speed added to the nominal speed, one per sample
+    - direction_errors (ndarray): degrees added to the nominal direction, one per sample
+    - fingerprint (str): hex digest of the samples, so plans and checkpoints keyed by problem_fingerprint() tell ensembles apart
+    """
+
+    def __init__(self, samples=1000, speed_sd=2, direction_sd=15, seed=0):
+        if np is None:
+            raise ImportError('numpy is required for wind ensembles')
+        rng = np.random.default_rng(seed)
+        self.speed_errors = rng.normal(0, speed_sd, samples)
+        self.direction_errors = rng.normal(0, direction_sd, samples)
+        self.fingerprint = hashlib.blake2b(self.speed_errors.tobytes() + self.direction_errors.tobytes(), digest_size=16).hexdigest()
+
+    def __len__(self):
+        return len(self.speed_errors)
+
+    def wind_factors(self, ux, uy, ws, wd, factor):
+        """Returns the wind factor of every sample (rows) on every leg (columns), given the unit direction
+        and nominal wind speed, direction and factor of every leg"""
+        speed = np.maximum(ws[None, :] + self.speed_errors[:, None], 0)
+        direction = np.radians(wd[None, :] + self.direction_errors[:, None])
+        dot_product = ux[None, :]*np.cos(direction) + uy[None, :]*np.sin(direction)
+        return np.exp(speed * factor[None, :] * dot_product * -1)
+
+
+
+class TerrainGrid:
+    """
+    TerrainGrid class holding ground and rooftop elevation on a regular grid, as read from an ESRI ASCII raster
+    A leg cruises above the highest cell along its straight line, found by sampling the line every half cell in one
+    vectorized pass; peaks are remembered per leg, so a leg is sampled once however often planning prices it
+    Attributes:
+    - heights (ndarray): elevation of every cell, row 0 is the northern edge as in the raster; NODATA cells count as 0
+    - x0, y0 (float): x and y of the lower left corner of the grid
+    - cellsize (float): width and height of a cell
+    - fingerprint (str): hex digest of the grid, so caches keyed by drone_fingerprint() tell terrains apart
+    - peaks (dict): highest elevation along every leg sampled so far, keyed by its end points
+    """
+
+    def __init__(self, heights, x0=0, y0=0, cellsize=1, nodata=None):
+        if np is None:
+            raise ImportError('numpy is required for terrain grids')
+        heights = np.array(heights, dtype=float)
+        if heights.ndim!=2 or heights.size==0:
+            raise Exception('Terrain needs a 2D grid of heights')
+        if cellsize<=0:
+            raise Exception('Terrain cells need a positive size')
+        if nodata is not None:
+            heights[heights==nodata] = 0
+        self.heights = heights
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.cellsize = float(cellsize)
+        grid = repr((heights.shape, self.x0, self.y0, self.cellsize)).encode() + heights.tobytes()
+        self.fingerprint = hashlib.blake2b(grid, digest_size=16).hexdigest()
+        self.peaks = dict()
+
+    def from_ascii(path):
+        """Reads an ESRI ASCII raster: a header of ncols, nrows, xllcorner or xllcenter, yllcorner or yllcenter,
+        cellsize and an optional NODATA_value, then nrows rows of ncols heights"""
+        header = dict()
+        with open(path) as file:
+            lines = file.read().splitlines()
+        first = 0
+        for line in lines:
+            parts = line.split()
+            if len(parts)>0 and not parts[0][0].isalpha():
+                break
+            if len(parts)>0:
+                header[parts[0].lower()] = float(parts[1])
+            first += 1
+        for key in ['ncols', 'nrows', 'cellsize']:
+            if key not in header:
+                raise Exception(f'{path} has no {key} in its header')
+        shape = (int(header['nrows']), int(header['ncols']))
+        values = ' '.join(lines[first:]).split()
+        if len(values)!=shape[0]*shape[1]:
+            raise Exception(f'{path} has {len(values)} heights, its header says {shape[0]}x{shape[1]}')
+        cellsize = header['cellsize']
+        #CENTER HEADERS GIVE THE MIDDLE OF THE LOWER LEFT CELL
+        x0 = header['xllcorner'] if 'xllcorner' in header else header.get('xllcenter', cellsize/2) - cellsize/2
+        y0 = header['yllcorner'] if 'yllcorner' in header else header.get('yllcenter', cellsize/2) - cellsize/2
+        return TerrainGrid(np.array(values, dtype=float).reshape(shape), x0, y0, cellsize, header.get('nodata_value'))
+
+    def highest(self, x1, y1, x2, y2):
+        """Returns the highest elevation along every straight line from (x1, y1) to (x2, y2), for broadcastable
+        arrays of end points; the parts of a line off the grid count as 0
+        Every line is sampled from its lower end point every half cell at most, so a line gets the same samples
+        whichever way it is flown and whichever lines it is sampled with"""
+        x1, y1, x2, y2 = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in (x1, y1, x2, y2)])
+        flip = (x1>x2) | ((x1==x2) & (y1>y2))
+        x1, x2 = np.where(flip, x2, x1), np.where(flip, x1, x2)
+        y1, y2 = np.where(flip, y2, y1), np.where(flip, y1, y2)
+        length = ((x2 - x1)**2 + (y2 - y1)**2)**0.5
+        steps = np.ceil(length / (self.cellsize/2)).astype(np.int64) + 1
+        #SHORTER LINES REPEAT THEIR END POINT UP TO THE LONGEST ONE
+        t = np.minimum(np.arange(int(steps.max(initial=1))) / np.maximum(steps - 1, 1)[..., None], 1)
+        xs = x1[..., None] + (x2 - x1)[..., None] * t
+        ys = y1[..., None] + (y2 - y1)[..., None] * t
+        rows, cols = self.heights.shape
+        col = np.floor((xs - self.x0) / self.cellsize).astype(np.int64)
+        row = rows - 1 - np.floor((ys - self.y0) / self.cellsize).astype(np.int64)
+        inside = (col>=0) & (col<cols) & (row>=0) & (row<rows)
+        elevation = np.where(inside, self.heights[np.clip(row, 0, rows-1), np.clip(col, 0, cols-1)], 0)
+        return elevation.max(axis=-1)
+
+    def peak(self, curr, nxt):
+        """Returns the highest elevation between two locations, sampling the line once per pair of end points"""
+        key = (curr.x, curr.y, nxt.x, nxt.y)
+        if (nxt.x, nxt.y)<(curr.x, curr.y):
+            key = (nxt.x, nxt.y, curr.x, curr.y)
+        if key not in self.peaks:
+            self.peaks[key] = float(self.highest(*key))
+        return self.peaks[key]
+
+
+PLANNING_POOL = None
+
+
+def planning_executor():
+    """Returns the thread pool shared by all plan_async() requests"""
+    global PLANNING_POOL
+    if PLANNING_POOL is None:
+        PLANNING_POOL = ThreadPoolExecutor()
+    return PLANNING_POOL
+
+
+def search_worker(delivery, packages, cancel=None):
+    """Runs the selected planner in an executor and returns [the path as positions in packages, whether it ran to the end]"""
+    positions = {id(package): i for i, package in enumerate(packages)}
+    path, complete = delivery.run_planner(packages, cancel)
+    return [[[positions[id(package)] for package in pool] for pool in path], complete]
+
+
+def plan_worker(delivery, packages, cancel=None):
+    """Plans in an executor and returns the path as positions in packages"""
+    positions = {id(package): i for i, package in enumerate(packages)}
+    path = delivery.plan(packages, cancel)
+    return [[positions[id(package)] for package in pool] for pool in path]
+
+
+KERNELS = dict()
+
+
+def build_kernels(jit=None):
+    """Returns the trip battery and path feasibility kernels over integer-encoded paths, compiled with jit if given
+    Row 0 of the leg tables is the base, package i is row i+1"""
+    def trip_battery(fixed, per_load, weights, positions, start, end):
+        load = 0.0
+        for k in range(start, end):
+            load += weights[positions[k]]
+        required = 0.0
+        curr = 0
+        for k in range(start, end):
+            nxt = positions[k] + 1
+            required += fixed[curr][nxt] + per_load[curr][nxt] * load
+            load -= weights[positions[k]]
+            curr = nxt
+        required += fixed[curr][0] + per_load[curr][0] * load
+        return required
+
+    if jit is not None:
+        trip_battery = jit(trip_battery)
+
+    def paths_feasible(fixed, per_load, weights, positions, pool_starts, path_starts, capacity, limit, feasible):
+        for p in range(len(path_starts) - 1):
+            met = True
+            for t in range(path_starts[p], path_starts[p+1]):
+                weight = 0.0
+                for k in range(pool_starts[t], pool_starts[t+1]):
+                    weight += weights[positions[k]]
+                if weight>capacity or trip_battery(fixed, per_load, weights, positions, pool_starts[t], pool_starts[t+1])>limit:
+                    met = False
+                    break
+            feasible[p] = met
+
+    if jit is not None:
+        paths_feasible = jit(paths_feasible)
+    return trip_battery, paths_feasible
+
+
+def kernel_backend(name):
+    """Returns the kernels of a backend, building them on first use; 'numba' falls back to
+    the Python kernels if numba (or numpy) is not installed"""
+    if name=='numba':
+        try:
+            import numba
+        except ImportError:
+            numba = None
+        if numba is None or np is None:
+            name = 'python'
+    if name not in KERNELS:
+        if name=='numba':
+            KERNELS[name] = build_kernels(numba.njit)
+        elif name=='python':
+            KERNELS[name] = build_kernels()
+        else:
+            raise Exception(f'Unknown kernel backend {name}')
+    return KERNELS[name]
+
+
+ATTACHED_PROBLEMS = dict()
+
+
+def evaluate_shard(spec, shard):
+    """Worker entry point: checks a shard of integer-encoded paths against a SharedProblem, attaching once per process"""
+    problem = ATTACHED_PROBLEMS.get(spec['name'])
+    if problem is None:
+        problem = SharedProblem.attach(spec)
+        ATTACHED_PROBLEMS[spec['name']] = problem
+    return [problem.path_feasible(path) for path in shard]
+
 
 def main():
 ##    p1 = Package(ID=1, location=Coordinate(5, 10,10), weight=10, quantity=1, priority='N')
@@ -1176,7 +3504,8 @@ def main():
     print(f'BEST PATH TIME: {deliv.simulate_time_and_battery(deliv.best_path)}')
     print(f'REMAINING BATTERY: {deliv.drone.current_battery()}')
 
-main()
+if __name__ == "__main__":
+    main()
 
 """
 UPDATES TO BE MADE:
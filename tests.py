@@ -1,12 +1,23 @@
 
-from bruteForceDrone import Drone, Environment, Package, Coordinate, Delivery
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from itertools import permutations
+
+from bruteforcedrone import Drone, Environment, Package, Coordinate, Delivery, WindForecast, WindEnsemble, FleetCostTables, LegCostCache, PlanCache, ParetoArchive, TerrainGrid, np, pulp
 
 
 def test_successful_delivery():
     p1 = Package(ID=1, location=Coordinate(1, 10),
-                 weight=5, quantity=1, priority=7)
+                 weight=5, quantity=1, priority='N')
     p2 = Package(ID=2, location=Coordinate(-2, -20),
-                 weight=6, quantity=1, priority=6)
+                 weight=6, quantity=1, priority='F')
     d1 = Drone("Drone1", 40, 25, 2000, 1.5, 600, 2.5)
     envioron = Environment(5, 60)
     packages = [p1, p2]
@@ -63,6 +74,815 @@ def test_failed_delivery_heavy_package():
     # assert deliv.deliver() == "Delivery failed: package too heavy for drone."
 
 
+def make_forecast_packages():
+    p1 = Package(ID=1, location=Coordinate(5, 10, 10),
+                 weight=10, quantity=1, priority='N')
+    p2 = Package(ID=2, location=Coordinate(-5, 10, 10),
+                 weight=11, quantity=1, priority='N')
+    return [p1, p2]
+
+
+def make_forecast_drone():
+    return Drone("Drone1", 40, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+
+
+def test_single_step_forecast_matches_environment():
+    static = Delivery(make_forecast_drone(), make_forecast_packages(), Environment(25, -63), True)
+    forecast = Delivery(make_forecast_drone(), make_forecast_packages(), WindForecast([(0, 25, -63)]), True)
+    static_battery = static.battery_required(static.remaining_packages)
+    forecast_battery = forecast.battery_required(forecast.remaining_packages, start_time=50)
+    assert abs(static_battery - forecast_battery) < 1e-6
+
+
+def test_forecast_bucket_changes_leg_cost():
+    forecast = WindForecast([(0, 25, -63), (100, 25, 117)])
+    assert forecast.bucket(-5) == 0
+    assert forecast.bucket(99) == 0
+    assert forecast.bucket(100) == 1
+    static = Delivery(make_forecast_drone(), make_forecast_packages(), Environment(25, -63), True)
+    deliv = Delivery(make_forecast_drone(), make_forecast_packages(), forecast, True)
+    early = deliv.battery_required(deliv.remaining_packages[:1], start_time=0)
+    late = deliv.battery_required(deliv.remaining_packages[:1], start_time=200)
+    assert abs(early - static.battery_required(static.remaining_packages[:1])) < 1e-6
+    assert early != late
+
+
+def test_forecast_checks_pools_when_they_leave():
+    #THE SECOND TRIP LEAVES AFTER t=10, INTO A HEADWIND IT CANNOT CARRY ON A FULL BATTERY
+    packages = [Package(ID=1, location=Coordinate(25, 0, 0), weight=2, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-30, 0, 0), weight=2, quantity=1, priority='N')]
+    forecast = WindForecast([(0, 0, 0), (10, 30, 0)])
+    d1 = Drone("Drone1", 3, 5, 6000, 10, 100, 50, height_rate=1.5, altitude=5, takeoff_rate=5)
+    deliv = Delivery(d1, list(packages), forecast, True)
+    assert deliv.best_path == []
+    assert all(deliv.has_enough_max_battery([package]) for package in packages)
+    assert not deliv.path_battery_verifier([[packages[0]], [packages[1]]])
+    pools = deliv.simulate_path([[packages[0]], [packages[1]]])[1]
+    assert pools[1] > d1.max_battery
+    d2 = Drone("Drone2", 3, 5, 40000, 10, 100, 50, height_rate=1.5, altitude=5, takeoff_rate=5)
+    deliv = Delivery(d2, list(packages), forecast, True)
+    states = deliv.simulate_state(deliv.best_path)
+    assert max(state.battery for state in states) <= d2.max_battery
+    #EVERY LEG DRAINS IN THE BUCKET IT LEAVES IN, AS PRICED BY THE PLAN
+    for start_time, env in [(0, Environment(0, 0)), (20, Environment(30, 0))]:
+        drained = []
+        for deliv in [Delivery(Drone("Drone3", 3, 5, 40000, 10, 100, 50, height_rate=1.5, altitude=5, takeoff_rate=5),
+                               list(packages), setting, True, autoplan=False) for setting in [forecast, env]]:
+            deliv.deliver_package(packages[1], 1, True, start_time=start_time)
+            deliv.return_to_base(1, True, start_time=start_time)
+            drained.append(40000 - deliv.drone.current_battery())
+        assert abs(drained[0] - drained[1]) < 1e-6
+
+
+def test_charge_schedule_reorders_urgent_pool():
+    normal = Package(ID=1, location=Coordinate(0, 30), weight=5, quantity=1, priority='N')
+    urgent = Package(ID=2, location=Coordinate(5, 0), weight=5, quantity=1, priority='U')
+    d1 = Drone("Drone1", 5, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, [normal, urgent], Environment(5, 60), optimize_charging=True)
+    path = [[normal], [urgent]]
+    ordered_path, charge_plan, completion_time = deliv.optimal_charge_schedule(path)
+    assert ordered_path == [[urgent], [normal]]
+    assert len(charge_plan) == 2
+    assert abs(completion_time - deliv.simulate_path(ordered_path, charge_plan)[2]) < 1e-9
+    assert deliv.path_priority_verifier(path)
+    deliv.optimize_charging = False
+    assert not deliv.path_priority_verifier(path)
+
+
+def test_charge_schedule_keeps_pool_order_under_forecast():
+    #UNDER A FORECAST THE POOL ORDER SETS THE BATTERY, BEST_PATH IS THE CHEAPEST ORDER
+    packages = [Package(ID=1, location=Coordinate(-9, 0, 0), weight=1, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(0, 14, 7), weight=1, quantity=1, priority='N')]
+    forecast = WindForecast([(0, 21, 4), (31, 8, -88)])
+    d1 = Drone("Drone1", 20, 5, 5200, 10, 100, 50, height_rate=1.5, altitude=1, takeoff_rate=2)
+    reference = Delivery(d1, list(packages), forecast, True, optimize_charging=True, autoplan=False)
+    expected = reference.minimum_battery_path(reference.filtered_paths(reference.all_possible_paths(list(packages))))
+    deliv = Delivery(d1, list(packages), forecast, True, optimize_charging=True)
+    assert deliv.best_path == expected
+    assert abs(deliv.path_battery_required(deliv.best_path) - reference.path_battery_required(expected)) < 1e-6
+    ordered_path, charge_plan, _ = deliv.optimal_charge_schedule(expected[::-1])
+    assert ordered_path == expected[::-1] and len(charge_plan) == 2
+
+
+def test_pareto_archive_matches_bruteforce_filter():
+    rng = random.Random(0)
+    for _ in range(50):
+        points = [tuple(rng.randint(0, 6) for _ in range(3)) for _ in range(rng.randint(1, 40))]
+        archive = ParetoArchive()
+        for i, point in enumerate(points):
+            dominated = any(all(a <= b for a, b in zip(other, point)) for other in archive.objectives)
+            assert archive.add(point, i) == (not dominated)
+        front = {point for point in points
+                 if not any(other != point and all(a <= b for a, b in zip(other, point)) for other in points)}
+        assert set(archive.objectives) == front and len(archive) == len(front)
+        assert archive.objectives == sorted(archive.objectives, key=lambda objectives: objectives[0])
+        assert all(points[path] == objectives for objectives, path in archive.entries())
+        for weights in [(1, 0, 0), (0, 1, 0), (1, 2, 3), (0.5, 0.1, 4)]:
+            objectives, path = archive.best(weights)
+            assert sum(w * o for w, o in zip(weights, objectives)) == min(sum(w * o for w, o in zip(weights, point)) for point in points)
+    assert ParetoArchive().best((1, 1, 1)) is None
+
+
+def test_pareto_paths_contain_minimum_battery_plan():
+    packages = [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, -10, 3), weight=6, quantity=1, priority='F'),
+                Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='U')]
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, packages, Environment(25, -63), True, autoplan=False)
+    archive = deliv.pareto_paths(deliv.remaining_packages)
+    assert len(archive) > 1
+    best_path = deliv.minimum_battery_path(deliv.filtered_paths(deliv.all_possible_paths(deliv.remaining_packages.copy())))
+    objectives = deliv.path_objectives(best_path)
+    assert objectives in archive.objectives
+    for entry, path in archive.entries():
+        assert entry == deliv.path_objectives(path)
+    assert archive.best((1, 0, 0))[0][0] <= objectives[0]
+
+
+def test_infeasible_urgent_mix_rejected_before_search():
+    packages = [Package(ID=i, location=Coordinate(5 * i, 10), weight=5, quantity=1, priority='U')
+                for i in range(1, 4)]
+    d1 = Drone("Drone1", 40, 25, 15000, 1.5, 600, 2.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, packages, Environment(5, 60))
+    assert len(deliv.remaining_packages) == 3
+    assert not deliv.urgent_batch_feasible(deliv.remaining_packages)
+    assert deliv.best_path == []
+
+
+def test_deadline_checks_on_shared_locations_and_pool_durations():
+    #A LOCKER SHARED BY TWO URGENT PACKAGES IS REACHED BY ONE LEG
+    locker = Coordinate(6, 0, 0)
+    d1 = Drone("Drone1", 40, 1, 15000, 10, 100, 50, height_rate=1.5, altitude=0, takeoff_rate=5)
+    deliv = Delivery(d1, [Package(ID=1, location=locker, weight=5, quantity=1, priority='U'),
+                          Package(ID=2, location=locker, weight=5, quantity=1, priority='U')], Environment(0, 0))
+    assert [[package.ID for package in pool] for pool in deliv.best_path] == [[1, 2]]
+    #THE URGENT POOL IS DUE TO LEAVE FIRST BUT TAKES LONGER, SO THE SHORT POOL GOES FIRST
+    b = Package(ID=1, location=Coordinate(3, 0), weight=5, quantity=1, priority='F')
+    u = Package(ID=2, location=Coordinate(0, 4), weight=5, quantity=1, priority='U')
+    n = Package(ID=3, location=Coordinate(0, 20), weight=5, quantity=1, priority='N')
+    d2 = Drone("Drone1", 40, 1, 15000, 10, 100, 50, height_rate=1.5, altitude=0, takeoff_rate=5)
+    deliv = Delivery(d2, [b, u, n], Environment(0, 0), autoplan=False)
+    assert deliv.edd_order([[u, n], [b]]) == [[b], [u, n]]
+    assert deliv.path_deadline_bound_verifier([[b], [u, n]]) and deliv.path_priority_verifier([[b], [u, n]])
+
+
+def test_pool_order_search_matches_original_bruteforce():
+    for planner in ['bruteforce', 'partition']:
+        b = Package(ID=1, location=Coordinate(3, 0), weight=5, quantity=1, priority='F')
+        u = Package(ID=2, location=Coordinate(0, 4), weight=5, quantity=1, priority='U')
+        n = Package(ID=3, location=Coordinate(0, 20), weight=5, quantity=1, priority='N')
+        d1 = Drone("Drone1", 10, 1, 15000, 0.1, 100, 1, height_rate=1.5, altitude=0, takeoff_rate=5)
+        deliv = Delivery(d1, [b, u, n], Environment(0, 0), planner=planner)
+        reference = deliv.minimum_battery_path(deliv.filtered_paths(deliv.all_possible_paths(deliv.remaining_packages.copy())))
+        assert abs(deliv.path_battery_required(deliv.best_path) - deliv.path_battery_required(reference)) < 1e-9
+        assert deliv.best_path == [[b], [u, n]]
+
+
+def test_trip_index_matches_permutation_search():
+    p1 = Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N')
+    p2 = Package(ID=2, location=Coordinate(-5, 10, 10), weight=11, quantity=1, priority='N')
+    p3 = Package(ID=3, location=Coordinate(-10, 20, 20), weight=12, quantity=1, priority='N')
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, [p1, p2, p3], Environment(25, -63))
+    trip_index = deliv.get_trip_index(deliv.remaining_packages)
+    for pool in [[p1], [p2, p1], [p3, p1], [p2, p3]]:
+        best = min(deliv.battery_required(list(order)) for order in permutations(pool))
+        order, battery, duration = trip_index.lookup(pool)
+        assert abs(battery - best) < 1e-6
+        assert abs(deliv.battery_required(deliv.min_battery_path(pool)) - best) < 1e-6
+    assert trip_index.lookup([p1, p2, p3]) is None
+    assert sorted(deliv.package_order(deliv.remaining_packages)) == [1, 2]
+
+
+def test_partition_planner_matches_bruteforce():
+    def make_packages():
+        return [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, 10, 10), weight=11, quantity=1, priority='F'),
+                Package(ID=3, location=Coordinate(-10, 20, 20), weight=12, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(-25, 26, 7), weight=13, quantity=1, priority='N')]
+    results = []
+    for planner in ['bruteforce', 'partition']:
+        d1 = Drone("Drone1", 40, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+        deliv = Delivery(d1, make_packages(), Environment(25, -63), True, planner=planner)
+        results.append(deliv.path_battery_required(deliv.best_path))
+        assert deliv.path_priority_verifier(deliv.best_path)
+    assert abs(results[0] - results[1]) < 1e-6
+
+
+def test_partition_planner_matches_bruteforce_under_forecast():
+    #LEG COSTS DEPEND ON THE BUCKET EVERY POOL LEAVES IN
+    def make_packages():
+        return [Package(ID=i, location=Coordinate(x, y, z), weight=weight, quantity=1, priority='N')
+                for i, (x, y, z, weight) in enumerate([(-15, 13, 6, 7), (4, 9, 0, 12), (-1, -7, 3, 10)])]
+    results = []
+    for planner in ['bruteforce', 'partition', 'anytime']:
+        d1 = Drone("Drone1", 20, 5, 16000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        deliv = Delivery(d1, make_packages(), WindForecast([(0, 30, -128), (25, 0, -169)]), True, planner=planner)
+        results.append(deliv.path_battery_required(deliv.best_path))
+        assert deliv.plan_report.optimal
+    assert max(results) - min(results) < 1e-6
+    updates = list(deliv.iter_plans(deliv.remaining_packages))
+    assert updates[-1].optimal and abs(updates[-1].battery - results[0]) < 1e-6
+
+
+def test_anytime_planner_reports_improving_plans():
+    packages = [Package(ID=i, location=Coordinate(3 * i - 10, 20 - 4 * i, i), weight=5 + i, quantity=1, priority='N')
+                for i in range(6)]
+    d1 = Drone("Drone1", 30, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, packages, Environment(25, -63), planner='partition')
+    updates = list(deliv.iter_plans(deliv.remaining_packages))
+    batteries = [update.battery for update in updates]
+    assert batteries == sorted(batteries, reverse=True)
+    assert updates[-1].optimal and updates[-1].gap == 0
+    assert abs(updates[-1].battery - deliv.path_battery_required(deliv.best_path)) < 1e-6
+    assert all(update.bound <= update.battery for update in updates)
+    cancel = threading.Event()
+    cancel.set()
+    #ONLY THE HEURISTIC FIRST PLAN IS OUT BEFORE THE SEARCH SEES THE CANCEL
+    path = deliv.plan_anytime(deliv.remaining_packages, cancel=cancel)
+    assert deliv.path_verifier(path) and deliv.path_battery_required(path) >= updates[-1].battery - 1e-6
+
+
+def test_anytime_budget_covers_trip_index():
+    rng = random.Random(1)
+    packages = [Package(ID=i, location=Coordinate(rng.randint(-20, 20), rng.randint(-20, 20), rng.randint(0, 5)),
+                        weight=rng.randint(1, 10), quantity=1, priority='N') for i in range(15)]
+    d1 = Drone("Drone1", 40, 5, 60000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, packages, Environment(10, 30), True, planner='anytime', autoplan=False)
+    deliv.time_budget = 0.3
+    start = time.monotonic()
+    path = deliv.plan(deliv.remaining_packages)
+    #THE INDEX OF 15 PACKAGES TAKES SECONDS TO BUILD
+    assert time.monotonic() - start < 1.5
+    assert len(path) > 0 and deliv.path_verifier(path) and not deliv.plan_report.optimal
+    trip_index = deliv.build_trip_index(packages, time.monotonic())
+    assert not trip_index.complete
+    assert not deliv.get_trip_index(packages, time.monotonic()).complete and len(deliv.trip_indexes) == 0
+
+
+def test_plan_async_matches_synchronous_plan():
+    def make_packages():
+        return [Package(ID=i, location=Coordinate(3 * i - 10, 20 - 4 * i, i), weight=5 + i, quantity=1, priority='N')
+                for i in range(5)]
+
+    def make_drone():
+        return Drone("Drone1", 30, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+
+    deliv = Delivery(make_drone(), make_packages(), Environment(25, -63), planner='partition')
+    deferred = Delivery(make_drone(), make_packages(), Environment(25, -63), planner='partition', autoplan=False)
+    assert deferred.best_path == []
+
+    async def plan_and_stream():
+        await deferred.plan_async()
+        assert all(package in deferred.remaining_packages for pool in deferred.best_path for package in pool)
+        return [event async for event in deferred.deliver_stream()]
+
+    events = asyncio.run(plan_and_stream())
+    assert abs(deferred.path_battery_required(deferred.best_path) - deliv.path_battery_required(deliv.best_path)) < 1e-6
+    assert [event['event'] for event in events].count('base') == len(deferred.best_path)
+
+
+def test_leg_cost_cache_persists_across_runs():
+    def make_delivery(leg_cache):
+        packages = [Package(ID=i, location=Coordinate(3 * i - 10, 20 - 4 * i, i), weight=5 + i, quantity=1, priority='N')
+                    for i in range(6)]
+        d1 = Drone("Drone1", 30, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+        return Delivery(d1, packages, Environment(25, -63), True, autoplan=False, leg_cache=leg_cache)
+
+    expected = make_delivery(None).get_leg_table()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'legs.cache')
+        cache = LegCostCache(path)
+        make_delivery(cache).get_leg_table()
+        cache.close()
+        cache = LegCostCache(path)
+        computed = []
+        warm = make_delivery(cache)
+        warm.battery_drain = lambda *args: computed.append(args)
+        table = warm.get_leg_table()
+        cache.close()
+        assert computed == []
+        assert table.fixed == expected.fixed and table.per_load == expected.per_load and table.time == expected.time
+
+        small = LegCostCache(os.path.join(directory, 'small.cache'), slots=16)
+        table = make_delivery(small).get_leg_table()
+        small.close()
+        assert table.fixed == expected.fixed
+        assert os.path.getsize(os.path.join(directory, 'small.cache')) == LegCostCache.HEADER.size + 16 * LegCostCache.RECORD.size
+
+        #A SHARED LOCATION OBJECT COSTS NOTHING TO STAY AT, TWO OBJECTS AT THE SAME SPOT STILL LAND AND TAKE OFF
+        def make_pair(shared, leg_cache):
+            first = Coordinate(5, 10, 0)
+            second = first if shared else Coordinate(5, 10, 0)
+            d1 = Drone("Drone1", 30, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+            return Delivery(d1, [Package(ID=1, location=first, weight=5, quantity=1, priority='N'),
+                                 Package(ID=2, location=second, weight=6, quantity=1, priority='N')],
+                            Environment(25, -63), True, autoplan=False, leg_cache=leg_cache)
+        pair_cache = LegCostCache(os.path.join(directory, 'pair.cache'))
+        make_pair(True, pair_cache).get_leg_table()
+        separate = make_pair(False, pair_cache)
+        expected = make_pair(False, None)
+        assert separate.get_leg_table().fixed == expected.get_leg_table().fixed
+        assert separate.get_leg_table().fixed[0][1][2] > 0
+        pair_cache.close()
+
+
+def test_parallel_verifier_matches_serial_checks():
+    packages = [Package(ID=i, location=Coordinate(3 * i - 10, 20 - 4 * i, i), weight=5 + i, quantity=1, priority='N')
+                for i in range(5)]
+    d1 = Drone("Drone1", 20, 5, 12000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, packages, Environment(25, -63), True, autoplan=False, workers=2)
+    deliv.SHARD_SIZE = 10
+    paths = deliv.all_possible_paths(deliv.remaining_packages.copy())
+    serial = [deliv.path_weight_verifier(path) and deliv.path_battery_verifier(path) for path in paths]
+    assert deliv.parallel_path_verifier(paths, deliv.remaining_packages) == serial
+    assert True in serial and False in serial
+
+
+def test_leg_trajectory_matches_stepwise_delivery():
+    if np is None:
+        return
+    p1 = Package(ID=1, location=Coordinate(5, -10, 3), weight=10, quantity=1, priority='N')
+    d1 = Drone("Drone1", 40, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, [p1], Environment(25, -63), True, autoplan=False)
+    deliv.drone.load([p1])
+    trajectory = deliv.leg_trajectory(deliv.drone.current_location(), p1.location, 50)
+    batteries = []
+    update_battery = deliv.drone.update_battery
+    deliv.drone.update_battery = lambda battery: (batteries.append(battery), update_battery(battery))
+    time_elapsed = deliv.deliver_package(p1, 50, True)
+    assert len(trajectory['battery']) == 151
+    assert np.allclose(trajectory['battery'][1:], batteries, rtol=0, atol=1e-9)
+    assert abs(trajectory['t'][-1] - time_elapsed) < 1e-9
+    location = deliv.drone.current_location()
+    assert (trajectory['x'][-1], trajectory['y'][-1], trajectory['z'][-1]) == (location.x, location.y, location.z)
+
+
+def test_state_simulation_leaves_drone_untouched():
+    p1 = Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N')
+    p2 = Package(ID=2, location=Coordinate(-5, -10, 3), weight=11, quantity=1, priority='N')
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, [p1, p2], Environment(25, -63), True)
+    start = d1.snapshot()
+    states = deliv.simulate_state(deliv.best_path)
+    _, pool_batteries, completion = deliv.simulate_path(deliv.best_path)
+    assert d1.snapshot() == start
+    assert abs(start.battery - states[-1].battery - sum(pool_batteries)) < 1e-9
+    assert abs(states[-1].time - completion) < 1e-9
+    assert states[-1].location().x == 0 and states[-1].load == 0
+    assert deliv.what_if([deliv.best_path], start) == [states[-1]]
+    #TWO PACKAGES IN ONE LOCKER: THE LEG BETWEEN THEM COSTS NOTHING, LIKE IN simulate_path
+    locker = Coordinate(8, -6, 4)
+    shared = [Package(ID=3, location=locker, weight=4, quantity=1, priority='N'),
+              Package(ID=4, location=locker, weight=3, quantity=1, priority='N')]
+    d2 = Drone("Drone2", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d2, shared, Environment(25, -63), True, autoplan=False)
+    states = deliv.simulate_state([shared])
+    _, pool_batteries, completion = deliv.simulate_path([shared])
+    assert abs(states[0].battery - states[-1].battery - sum(pool_batteries)) < 1e-9
+    assert abs(states[-1].time - completion) < 1e-9
+
+
+def test_wind_ensemble_and_chance_constraint():
+    if np is None:
+        return
+    packages = [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, -10, 3), weight=11, quantity=1, priority='N'),
+                Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N')]
+    forecast = WindForecast([(0, 25, -63), (20, 5, 90), (60, 30, 180)])
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, packages, forecast, True, autoplan=False, wind_ensemble=WindEnsemble(4, 0, 0))
+    for start_time in [0, 30]:
+        samples = deliv.pool_battery_samples(packages, start_time)
+        assert np.allclose(samples, deliv.battery_required(packages, start_time=start_time), rtol=1e-12)
+
+    plans = []
+    for planner in ['bruteforce', 'partition']:
+        for tolerance in [None, 0.01]:
+            d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+            deliv = Delivery(d1, list(packages), Environment(25, -63), True, planner=planner, breach_tolerance=tolerance,
+                             wind_ensemble=WindEnsemble(2000, 3, 20))
+            plans.append([deliv.path_battery_required(deliv.best_path), deliv.breach_probability(deliv.best_path)])
+    assert plans[0] == plans[2] and plans[1] == plans[3]
+    assert plans[0][1] > 0.01 >= plans[1][1]
+    assert plans[1][0] > plans[0][0]
+
+    #THE CHEAPEST ORDER OF THE POOL BREACHES TOO OFTEN, A COSTLIER ONE DOES NOT
+    batteries = []
+    for planner in ['bruteforce', 'partition']:
+        d1 = Drone("Drone1", 20, 5, 13900, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        deliv = Delivery(d1, [Package(ID=1, location=Coordinate(-7, 6, 8), weight=4, quantity=1, priority='N'),
+                              Package(ID=2, location=Coordinate(-1, 7, 6), weight=3, quantity=1, priority='N')],
+                         Environment(23, -160), True, planner=planner, breach_tolerance=0.01,
+                         wind_ensemble=WindEnsemble(300, speed_sd=4, direction_sd=40))
+        batteries.append(deliv.path_battery_required(deliv.best_path))
+        assert deliv.breach_probability(deliv.best_path) <= 0.01
+    assert abs(batteries[0] - batteries[1]) < 1e-6
+
+
+def test_fleet_tables_match_per_drone_tables():
+    if np is None:
+        return
+    packages = [Package(ID=i, location=Coordinate(3 * i - 10, 20 - 4 * i, i % 4), weight=5 + i, quantity=1, priority='N')
+                for i in range(5)]
+    forecast = WindForecast([(0, 25, -63), (20, 5, 90)])
+    drones = [Drone("Drone" + str(k), 20, 5 + k, 12000, 10 + k, 100, 50 - 5 * k, height_rate=1.5, altitude=10 + k,
+                    takeoff_rate=5) for k in range(3)]
+    fleet = FleetCostTables(packages, forecast, True, drones)
+    assert len(fleet.tables) == 3
+    for drone in drones:
+        deliv = Delivery(drone, list(packages), forecast, True, autoplan=False)
+        table = deliv.build_leg_tables(deliv.remaining_packages)
+        deliv.fleet_tables = fleet
+        fleet_table = deliv.build_leg_tables(deliv.remaining_packages)
+        for field in ['fixed', 'per_load', 'time']:
+            assert np.allclose(getattr(fleet_table, field), getattr(table, field), rtol=1e-12, atol=1e-9)
+        plain = Delivery(drone, list(packages), Environment(25, -63), True, planner='partition')
+        shared = Delivery(drone, list(packages), Environment(25, -63), True, planner='partition',
+                          fleet_tables=FleetCostTables(packages, Environment(25, -63), True, drones))
+        assert abs(plain.path_battery_required(plain.best_path) - shared.path_battery_required(shared.best_path)) < 1e-6
+    for env, setenv in [(Environment(25, -63), True), (forecast, False), (WindForecast([(0, 25, -63), (30, 5, 90)]), True)]:
+        try:
+            deliv = Delivery(drones[0], list(packages), env, setenv, autoplan=False, fleet_tables=fleet)
+            deliv.build_leg_tables(deliv.remaining_packages)
+            assert False
+        except Exception as e:
+            assert 'another environment' in str(e)
+
+
+def test_kernel_backends_match_battery_drain():
+    packages = [Package(ID=i, location=Coordinate(7 * i - 15, 12 - 5 * i, i % 3 * 4), weight=3 + i, quantity=1, priority='N')
+                for i in range(6)]
+    serial = None
+    for kernel in ['python', 'numba']:
+        d1 = Drone("Drone1", 20, 5, 12000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+        deliv = Delivery(d1, list(packages), Environment(25, -63), True, autoplan=False, kernel=kernel)
+        for order in permutations(deliv.remaining_packages[:4]):
+            required = deliv.battery_required(list(order))
+            assert abs(deliv.kernel_pool_battery(list(order)) - required) <= 1e-9 * required
+        paths = deliv.canonical_paths(deliv.remaining_packages)
+        if serial is None:
+            serial = [deliv.path_weight_verifier(path) and deliv.path_battery_verifier(path) for path in paths]
+            assert True in serial and False in serial
+        assert deliv.kernel_path_verifier(paths, deliv.remaining_packages) == serial
+
+
+def test_milp_planner_matches_partition_planner():
+    if pulp is None:
+        return
+    packages = [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, -10, 3), weight=6, quantity=1, priority='F'),
+                Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(-12, 8, 6), weight=8, quantity=1, priority='N'),
+                Package(ID=5, location=Coordinate(3, -14, 0), weight=4, quantity=1, priority='N'),
+                Package(ID=6, location=Coordinate(10, 10, 4), weight=7, quantity=1, priority='N')]
+    batteries = []
+    for planner in ['partition', 'milp']:
+        d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        deliv = Delivery(d1, list(packages), Environment(25, -63), True, planner=planner)
+        assert len(deliv.best_path) > 1 and deliv.path_priority_verifier(deliv.best_path)
+        batteries.append(deliv.path_battery_required(deliv.best_path))
+        greedy = deliv.greedy_path(deliv.remaining_packages)
+        assert greedy == [] or deliv.path_battery_required(greedy) >= batteries[-1] - 1e-6
+    assert abs(batteries[0] - batteries[1]) < 1e-6
+    #CBC PROVES THE BATCH WITHIN A GENEROUS LIMIT; A TINY ONE ONLY LEAVES TIME FOR THE HEURISTIC PLAN
+    path, proven = deliv.milp_best_path(deliv.remaining_packages, 60)
+    assert proven and abs(deliv.path_battery_required(path) - batteries[1]) < 1e-6
+    path, proven = deliv.milp_best_path(deliv.remaining_packages, 1e-6)
+    assert not proven and deliv.path_verifier(path)
+
+    batteries = []
+    for planner in ['partition', 'milp']:
+        d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        deliv = Delivery(d1, [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                              Package(ID=2, location=Coordinate(-5, -10, 3), weight=11, quantity=1, priority='N'),
+                              Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N')],
+                         Environment(25, -63), True, planner=planner, breach_tolerance=0.01, wind_ensemble=WindEnsemble(2000, 3, 20))
+        assert deliv.breach_probability(deliv.best_path) <= 0.01
+        batteries.append(deliv.path_battery_required(deliv.best_path))
+    assert abs(batteries[0] - batteries[1]) < 1e-6
+
+
+def test_clustered_plan_matches_whole_batch():
+    centers = [(0, 0), (90, 0), (-70, 70)]
+    packages = [Package(ID=i, location=Coordinate(centers[i % 3][0] + i % 5 - 2, centers[i % 3][1] + 2 - i % 4, i % 6),
+                        weight=3 + i % 5, quantity=1, priority='N') for i in range(9)]
+    batteries = []
+    for cluster in [False, True]:
+        d1 = Drone("Drone1", 25, 5, 20000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        deliv = Delivery(d1, list(packages), Environment(25, -63), True, planner='partition', cluster=cluster)
+        groups = deliv.package_clusters(deliv.remaining_packages)
+        assert len(groups) > 1
+        batteries.append(deliv.path_battery_required(deliv.best_path))
+    for pool in deliv.best_path:
+        assert any(all(package in group for package in pool) for group in groups)
+    assert abs(batteries[0] - batteries[1]) < 1e-6
+
+    #EVERY GROUP ALONE MEETS THE CHANCE CONSTRAINT, THE TWO TOGETHER DO NOT
+    if np is not None:
+        for cluster in [False, True]:
+            d1 = Drone("Drone1", 25, 5, 11000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+            deliv = Delivery(d1, [Package(ID=1, location=Coordinate(24, 0, 0), weight=15, quantity=1, priority='N'),
+                                  Package(ID=2, location=Coordinate(-24, -20, 0), weight=15, quantity=1, priority='N')],
+                             Environment(25, -63), True, planner='partition', cluster=cluster, breach_tolerance=0.12,
+                             wind_ensemble=WindEnsemble())
+            assert len(deliv.package_clusters(deliv.remaining_packages)) == 2
+            assert deliv.best_path == []
+
+
+def test_feasibility_filter_matches_single_package_checks():
+    packages = [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(0, -10, 3), weight=30, quantity=1, priority='N'),
+                Package(ID=3, location=Coordinate(-60, 45, 20), weight=10, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(12, -8, 4), weight=5, quantity=1, priority='U'),
+                Package(ID=5, location=Coordinate(-4, 6, 0), weight=4, quantity=1, priority='F')]
+    for env in [Environment(25, -63), WindForecast([(0, 25, -63), (12, 5, 90)])]:
+        d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+        caller_packages = list(packages)
+        deliv = Delivery(d1, caller_packages, env, True, autoplan=False)
+        assert caller_packages == packages
+        assert deliv.remaining_packages == [packages[0], packages[4]]
+        assert [[package.ID, reason] for package, reason in deliv.rejected_packages] == [
+            [2, Delivery.FILTER_WEIGHT], [3, Delivery.FILTER_BATTERY], [4, Delivery.FILTER_DEADLINE]]
+        if np is not None:
+            battery, arrival = deliv.round_trips(packages)
+            for i, package in enumerate(packages):
+                assert abs(battery[i] - deliv.battery_required([package])) < 1e-9
+                assert abs(arrival[i] - deliv.time_drain(deliv.base, package.location)) < 1e-12
+
+
+def test_plan_cache_ignores_package_order():
+    def make_packages():
+        return [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, -10, 3), weight=6, quantity=1, priority='N'),
+                Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N')]
+
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = PlanCache(capacity=1, directory=directory)
+        deliv = Delivery(d1, make_packages(), Environment(25, -63), True, planner='partition', plan_cache=cache)
+        assert len(cache) == 1
+        shuffled = make_packages()[::-1]
+        replay = Delivery(d1, shuffled, Environment(25, -63), True, planner='partition', autoplan=False,
+                          plan_cache=PlanCache(directory=directory))
+        assert replay.problem_fingerprint(replay.remaining_packages) == deliv.problem_fingerprint(deliv.remaining_packages)
+        path = replay.plan(replay.remaining_packages)
+        assert sorted(id(package) for pool in path for package in pool) == sorted(id(package) for package in shuffled)
+        assert abs(replay.path_battery_required(path) - deliv.path_battery_required(deliv.best_path)) < 1e-9
+        windy = Delivery(d1, make_packages(), Environment(20, -63), True, planner='partition', plan_cache=cache)
+        assert windy.problem_fingerprint(windy.remaining_packages) != deliv.problem_fingerprint(deliv.remaining_packages)
+        if np is not None:
+            fingerprints = set()
+            for ensemble in [WindEnsemble(200, seed=1), WindEnsemble(200, seed=2), WindEnsemble(200, speed_sd=3, seed=1)]:
+                chance = Delivery(d1, make_packages(), Environment(25, -63), True, planner='partition', autoplan=False,
+                                  breach_tolerance=0.01, wind_ensemble=ensemble)
+                fingerprints.add(chance.problem_fingerprint(chance.remaining_packages))
+            chance.CHARGE_LEVELS += 1
+            fingerprints.add(chance.problem_fingerprint(chance.remaining_packages))
+            assert len(fingerprints) == 4
+        assert len(cache) == 1 and len(os.listdir(directory)) == 2
+
+
+def test_plan_cache_skips_truncated_searches():
+    rng = random.Random(1)
+    packages = [Package(ID=i, location=Coordinate(rng.randint(-20, 20), rng.randint(-20, 20), rng.randint(0, 5)),
+                        weight=rng.randint(1, 10), quantity=1, priority='N') for i in range(15)]
+    d1 = Drone("Drone1", 40, 5, 60000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    cache = PlanCache()
+    deliv = Delivery(d1, packages, Environment(10, 30), True, planner='anytime', autoplan=False, plan_cache=cache)
+    deliv.time_budget = 0.3
+    assert len(deliv.plan(deliv.remaining_packages)) > 0
+    assert len(cache) == 0 and not deliv.plan_report.optimal
+    deliv.time_budget = 60
+    deliv.plan(deliv.remaining_packages[:5])
+    assert len(cache) == 1 and deliv.plan_report.optimal
+
+
+def test_lower_bound_and_plan_gap():
+    packages = [Package(ID=i, location=Coordinate(7 * i - 15, 12 - 5 * i, i % 3 * 4), weight=3 + i, quantity=1, priority='N')
+                for i in range(6)]
+    for env in [Environment(25, -63), WindForecast([(0, 25, -63), (20, 5, 90)])]:
+        d1 = Drone("Drone1", 20, 5, 12000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+        deliv = Delivery(d1, list(packages), env, True)
+        report = deliv.plan_report
+        assert report.optimal and report.gap == 0
+        assert 0 < deliv.lower_bound(deliv.remaining_packages) <= report.battery
+    if pulp is None:
+        return
+    d1 = Drone("Drone1", 20, 5, 12000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, list(packages), Environment(25, -63), True, planner='milp', autoplan=False)
+    deliv.time_budget = 1e-6
+    deliv.plan(deliv.remaining_packages)
+    assert not deliv.plan_report.optimal and 0 < deliv.plan_report.gap < 1
+    #CBC PROVES THIS BATCH OPTIMAL WELL WITHIN THE BUDGET
+    deliv.time_budget = 60
+    deliv.plan(deliv.remaining_packages)
+    assert deliv.plan_report.optimal and deliv.plan_report.gap == 0
+
+
+DIFFERENTIAL_ENGINES = [{'planner': 'bruteforce'}, {'planner': 'partition'}, {'planner': 'anytime'}, {'planner': 'milp'},
+                        {'planner': 'partition', 'cluster': True}, {'planner': 'bruteforce', 'kernel': 'python'},
+                        {'planner': 'bruteforce', 'kernel': 'numba'}]
+
+
+def random_instance(rng):
+    """Returns a small random batch: up to 4 packages (x, y, z, weight, priority), a tight battery, wind on or off,
+    a drone climbing to a random altitude at a random rate so 'U' and 'F' deadlines bind, and sometimes a forecast
+    (steps after the first), a chance constraint, an optimized charge schedule or a terrain grid"""
+    return {'packages': [(rng.randint(-15, 15), rng.randint(-15, 15), rng.randint(0, 8), rng.randint(1, 15),
+                          rng.choice(['N', 'N', 'F', 'U'])) for _ in range(rng.randint(1, 4))],
+            'battery': rng.randint(40, 160) * 100, 'setenv': rng.random() < 0.5,
+            'ws': rng.randint(0, 30), 'wd': rng.randint(-180, 180),
+            'altitude': rng.randint(0, 10), 'takeoff_rate': rng.choice([2, 5, 10, 20]),
+            'steps': [(rng.randint(1, 40), rng.randint(0, 30), rng.randint(-180, 180))
+                      for _ in range(rng.choice([0, 0, 0, 1, 2]))],
+            'tolerance': rng.choice([None, None, None, 0, 0.1, 0.3]), 'charging': rng.random() < 0.2,
+            'terrain': [[rng.choice([0, 0, 0, 5, 20]) for _ in range(8)] for _ in range(8)] if rng.random() < 0.2 else None}
+
+
+def instance_delivery(instance, **options):
+    packages = [Package(ID=i, location=Coordinate(x, y, z), weight=weight, quantity=1, priority=priority)
+                for i, (x, y, z, weight, priority) in enumerate(instance['packages'])]
+    d1 = Drone("Drone1", 20, 5, instance['battery'], 10, 100, 50, height_rate=1.5, altitude=instance['altitude'],
+               takeoff_rate=instance['takeoff_rate'])
+    env = Environment(instance['ws'], instance['wd'])
+    if len(instance['steps']) > 0:
+        env = WindForecast([(0, instance['ws'], instance['wd'])] + sorted(instance['steps']))
+    if instance['tolerance'] is not None:
+        options.update(breach_tolerance=instance['tolerance'], wind_ensemble=WindEnsemble(50, 3, 20))
+    if instance['terrain'] is not None:
+        options.update(terrain=TerrainGrid(instance['terrain'], -20, -20, 5))
+    return Delivery(d1, packages, env, instance['setenv'], optimize_charging=instance['charging'], **options)
+
+
+def engine_disagreement(instance):
+    """Returns how an engine disagrees with the original brute force (every permutation of every split) on an
+    instance, or None if they all agree on the optimal battery, return feasible paths and report sound bounds
+    Every path is also flown pool by pool with the state API, every leg draining in the forecast bucket it leaves in,
+    since the brute force shares its battery checks with the engines"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = instance_delivery(instance, autoplan=False)
+        expected = reference.minimum_battery_path(reference.filtered_paths(reference.all_possible_paths(reference.remaining_packages.copy())))
+        expected_battery = reference.path_battery_required(expected)
+        for options in DIFFERENTIAL_ENGINES:
+            if options['planner'] == 'milp' and (pulp is None or len(instance['steps']) > 0):
+                continue
+            deliv = instance_delivery(instance, **options)
+            path = deliv.best_path
+            if (len(path) == 0) != (len(expected) == 0):
+                return f'{options} found {path}, brute force found {expected}'
+            if len(path) == 0:
+                continue
+            if sorted(package.ID for pool in path for package in pool) != sorted(package.ID for package in deliv.remaining_packages):
+                return f'{options} does not deliver every package once: {path}'
+            if not deliv.path_verifier(path):
+                return f'{options} returned an infeasible path {path}'
+            batteries = [state.battery for state in deliv.simulate_state(path, charge_plan=deliv.charge_plan)]
+            if max(batteries) > deliv.drone.max_battery + 1e-6 or min(batteries) < deliv.drone.emergency_amount_battery - 1e-6:
+                return f'{options} flies {path} on {min(batteries)} to {max(batteries)} battery'
+            battery = deliv.path_battery_required(path)
+            if abs(battery - expected_battery) > 1e-6 * expected_battery:
+                return f'{options} needs {battery} battery, brute force {expected_battery}'
+            report = deliv.plan_report
+            if report.bound > expected_battery * (1 + 1e-6) or not report.optimal:
+                return f'{options} reports bound {report.bound}, optimal {report.optimal} for {expected_battery} battery'
+    return None
+
+
+def shrink_instance(instance):
+    """Drops packages and forecast steps, turns the wind, chance constraint, charge schedule and terrain off and
+    pulls numbers to 0, weight 1 and priority 'N' while the engines still disagree, returning a minimal reproducer"""
+    simplest = (0, 0, 0, 1, 'N')
+    while True:
+        packages, steps = instance['packages'], instance['steps']
+        candidates = [dict(instance, packages=packages[:i] + packages[i+1:]) for i in range(len(packages))]
+        candidates += [dict(instance, steps=steps[:i] + steps[i+1:]) for i in range(len(steps))]
+        for i, package in enumerate(packages):
+            for k, value in enumerate(package):
+                if value != simplest[k]:
+                    simpler = package[:k] + (simplest[k],) + package[k+1:]
+                    candidates.append(dict(instance, packages=packages[:i] + [simpler] + packages[i+1:]))
+        for key, value in [('setenv', False), ('ws', 0), ('wd', 0), ('altitude', 0), ('tolerance', None),
+                           ('charging', False), ('terrain', None)]:
+            if instance[key] != value:
+                candidates.append(dict(instance, **{key: value}))
+        for candidate in candidates:
+            if engine_disagreement(candidate) is not None:
+                instance = candidate
+                break
+        else:
+            return instance
+
+
+def test_audit_brute_force_resumes_from_checkpoint():
+    packages = [Package(ID=1, location=Coordinate(5, 10, 10), weight=10, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(-5, -10, 3), weight=6, quantity=1, priority='F'),
+                Package(ID=3, location=Coordinate(15, 0, 2), weight=5, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(-12, 8, 4), weight=4, quantity=1, priority='N')]
+    d1 = Drone("Drone1", 25, 5, 15000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=2)
+    deliv = Delivery(d1, list(packages), Environment(25, -63), True)
+    candidates = set(tuple(tuple(package.ID for package in pool) for pool in deliv.audit_path(packages, index))
+                     for index in range(deliv.audit_size(packages)))
+    assert len(candidates) == deliv.audit_size(packages) == 192
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, 'audit.json')
+        path, completed = deliv.audit_best_path(packages, chunk_size=50, checkpoint=checkpoint, max_chunks=2)
+        assert not completed and os.path.exists(checkpoint)
+        while not completed:
+            path, completed = deliv.audit_best_path(packages[::-1], chunk_size=50, checkpoint=checkpoint, max_chunks=1)
+        assert abs(deliv.path_battery_required(path) - deliv.path_battery_required(deliv.best_path)) < 1e-9
+        try:
+            deliv.audit_best_path(packages[:3], checkpoint=checkpoint)
+            assert False
+        except Exception as e:
+            assert 'another problem' in str(e)
+    empty = Delivery(d1, [], Environment(25, -63), True, planner='audit')
+    assert empty.best_path == [] and empty.audit_best_path([]) == [[], True]
+
+
+class CancelAfter:
+    """Stands in for a threading.Event that gets set after a number of checks, like a preempted worker"""
+    def __init__(self, checks):
+        self.checks = checks
+
+    def is_set(self):
+        self.checks -= 1
+        return self.checks<0
+
+
+def test_partition_search_resumes_from_checkpoint():
+    packages = [Package(ID=i, location=Coordinate(7 * i - 15, 12 - 5 * i, i % 3 * 4), weight=3 + i, quantity=1, priority='N')
+                for i in range(6)]
+    d1 = Drone("Drone1", 20, 5, 30000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    deliv = Delivery(d1, list(packages), Environment(25, -63), True, planner='partition')
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, 'search.json')
+        runs = 0
+        while True:
+            runs += 1
+            path = deliv.partition_best_path(packages[::(-1)**runs], CancelAfter(5), checkpoint)
+            with open(checkpoint) as file:
+                if json.load(file)['positions'] == []:
+                    break
+        assert runs>1
+        assert abs(deliv.path_battery_required(path) - deliv.path_battery_required(deliv.best_path)) < 1e-9
+        resumed = Delivery(d1, list(packages), Environment(25, -63), True, planner='partition', checkpoint=checkpoint)
+        assert abs(resumed.path_battery_required(resumed.best_path) - deliv.path_battery_required(path)) < 1e-9
+        try:
+            Delivery(d1, packages[:4], Environment(25, -63), True, planner='partition', checkpoint=checkpoint)
+            assert False
+        except Exception as e:
+            assert 'another problem' in str(e)
+
+
+def test_terrain_raises_cruise_height():
+    if np is None:
+        return
+    heights = [[0]*8 for _ in range(8)]
+    heights[2][5] = 30
+    heights[6][1] = -9999
+    with tempfile.TemporaryDirectory() as directory:
+        raster = os.path.join(directory, 'city.asc')
+        with open(raster, 'w') as file:
+            file.write('ncols 8\nnrows 8\nxllcorner -20\nyllcorner -20\ncellsize 5\nNODATA_value -9999\n')
+            file.write('\n'.join(' '.join(str(height) for height in row) for row in heights))
+        terrain = TerrainGrid.from_ascii(raster)
+    assert terrain.heights[6][1] == 0 and terrain.heights.max() == 30
+    packages = [Package(ID=1, location=Coordinate(15, 15, 0), weight=6, quantity=1, priority='N'),
+                Package(ID=2, location=Coordinate(12, 5, 2), weight=5, quantity=1, priority='N'),
+                Package(ID=3, location=Coordinate(-10, -10, 2), weight=4, quantity=1, priority='N'),
+                Package(ID=4, location=Coordinate(5, 18, 4), weight=3, quantity=1, priority='N')]
+    d1 = Drone("Drone1", 20, 5, 30000, 10, 100, 50, height_rate=1.5, altitude=10, takeoff_rate=5)
+    flat = Delivery(d1, list(packages), Environment(25, -63), True, planner='partition')
+    city = Delivery(d1, list(packages), Environment(25, -63), True, planner='partition', terrain=terrain)
+    #THE TOWER STANDS ON THE CELL x IN [5, 10], y IN [5, 10], RIGHT ON THE WAY TO PACKAGE 1
+    assert city.cruise_height(city.base, packages[0].location) == city.cruise_height(packages[0].location, city.base) == 40
+    assert flat.cruise_height(flat.base, packages[0].location) == 10
+    assert city.cruise_height(city.base, packages[2].location) == 12
+    assert city.drone_fingerprint() != flat.drone_fingerprint()
+    table = city.build_leg_tables(city.remaining_packages)
+    city.fleet_tables = FleetCostTables(packages, Environment(25, -63), True, [d1], terrain=terrain)
+    fleet_table = city.build_leg_tables(city.remaining_packages)
+    for field in ['fixed', 'per_load', 'time']:
+        assert np.allclose(getattr(fleet_table, field), getattr(table, field), rtol=1e-12, atol=1e-9)
+    battery, arrival = city.round_trips(packages)
+    for i, package in enumerate(packages):
+        assert abs(battery[i] - city.battery_required([package])) < 1e-9
+        assert abs(arrival[i] - city.time_drain(city.base, package.location)) < 1e-12
+    assert city.path_battery_required(city.best_path) > flat.path_battery_required(flat.best_path)
+
+
+def test_fast_engines_match_bruteforce():
+    rng = random.Random(0)
+    for _ in range(int(os.environ.get('DIFFERENTIAL_CASES', 1000))):
+        instance = random_instance(rng)
+        failure = engine_disagreement(instance)
+        if failure is not None:
+            reproducer = shrink_instance(instance)
+            assert False, f'{engine_disagreement(reproducer)} on {reproducer}'
+
+
 def main():
     test_successful_delivery()
     print('\n'*5, "Test Successful delivery", '\n'*5)
@@ -77,6 +897,64 @@ def main():
         print('\n'*5, "Test Failed delivery heavy package", '\n'*5)
     except:
         print("Test Failed delivery heavy package")
+    test_single_step_forecast_matches_environment()
+    test_forecast_bucket_changes_leg_cost()
+    test_forecast_checks_pools_when_they_leave()
+    print('\n'*5, "Test wind forecast", '\n'*5)
+    test_charge_schedule_reorders_urgent_pool()
+    print('\n'*5, "Test charge schedule", '\n'*5)
+    test_charge_schedule_keeps_pool_order_under_forecast()
+    print('\n'*5, "Test charge schedule under forecast", '\n'*5)
+    test_pareto_archive_matches_bruteforce_filter()
+    test_pareto_paths_contain_minimum_battery_plan()
+    print('\n'*5, "Test pareto front", '\n'*5)
+    test_infeasible_urgent_mix_rejected_before_search()
+    print('\n'*5, "Test infeasible urgent mix", '\n'*5)
+    test_deadline_checks_on_shared_locations_and_pool_durations()
+    test_pool_order_search_matches_original_bruteforce()
+    test_trip_index_matches_permutation_search()
+    print('\n'*5, "Test trip index", '\n'*5)
+    test_partition_planner_matches_bruteforce()
+    test_partition_planner_matches_bruteforce_under_forecast()
+    print('\n'*5, "Test partition planner", '\n'*5)
+    test_anytime_planner_reports_improving_plans()
+    test_anytime_budget_covers_trip_index()
+    print('\n'*5, "Test anytime planner", '\n'*5)
+    test_plan_async_matches_synchronous_plan()
+    print('\n'*5, "Test async planning", '\n'*5)
+    test_leg_cost_cache_persists_across_runs()
+    print('\n'*5, "Test leg cost cache", '\n'*5)
+    test_parallel_verifier_matches_serial_checks()
+    print('\n'*5, "Test parallel verifier", '\n'*5)
+    test_leg_trajectory_matches_stepwise_delivery()
+    print('\n'*5, "Test vectorized trajectory", '\n'*5)
+    test_state_simulation_leaves_drone_untouched()
+    print('\n'*5, "Test state simulation", '\n'*5)
+    test_wind_ensemble_and_chance_constraint()
+    print('\n'*5, "Test wind ensemble", '\n'*5)
+    test_fleet_tables_match_per_drone_tables()
+    print('\n'*5, "Test fleet cost tables", '\n'*5)
+    test_kernel_backends_match_battery_drain()
+    print('\n'*5, "Test kernel backends", '\n'*5)
+    test_milp_planner_matches_partition_planner()
+    print('\n'*5, "Test milp planner", '\n'*5)
+    test_clustered_plan_matches_whole_batch()
+    print('\n'*5, "Test clustered planning", '\n'*5)
+    test_feasibility_filter_matches_single_package_checks()
+    print('\n'*5, "Test feasibility filter", '\n'*5)
+    test_plan_cache_ignores_package_order()
+    test_plan_cache_skips_truncated_searches()
+    print('\n'*5, "Test plan cache", '\n'*5)
+    test_lower_bound_and_plan_gap()
+    print('\n'*5, "Test lower bound", '\n'*5)
+    test_audit_brute_force_resumes_from_checkpoint()
+    print('\n'*5, "Test audit brute force", '\n'*5)
+    test_partition_search_resumes_from_checkpoint()
+    print('\n'*5, "Test search checkpoints", '\n'*5)
+    test_terrain_raises_cruise_height()
+    print('\n'*5, "Test terrain", '\n'*5)
+    test_fast_engines_match_bruteforce()
+    print('\n'*5, "Test engines against brute force", '\n'*5)
 
 
 if __name__ == "__main__":